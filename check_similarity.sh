@@ -30,6 +30,11 @@ if [ -z "$USERID" ]; then
   exit 1
 fi
 
+# MOSS_SERVER=host:port sends the submissions to another server, such as moss_standin_server.py.
+if [ ! -z "${MOSS_SERVER}" ]; then
+  MOSS_SERVER_FLAG="--moss-server ${MOSS_SERVER}"
+fi
+
 if [ "${FORCE}" = "TRUE" ]; then
   echo "FORCE flag is set."
   FORCE_FLAG="--force"
@@ -47,6 +52,33 @@ else
   DUE_DATE="$1"
 fi
 
+# INCREMENTAL=TRUE only sends new or changed submissions to MOSS and merges the
+# matches into the report of the previous INCREMENTAL=TRUE run.
+if [ "${INCREMENTAL}" = "TRUE" ]; then
+  INCREMENTAL_FLAG="--incremental"
+fi
+
+# EXPORT_ZIP=path/to/export.zip reads the gradescope export without extracting it.
+if [ ! -z "${EXPORT_ZIP}" ]; then
+  EXPORT_FLAG="--assignment-files-directory ${EXPORT_ZIP}"
+fi
+
+# LINK_FILES=TRUE hardlinks (or reflinks/symlinks) the code files into ./sorted instead of copying them.
+if [ "${LINK_FILES}" = "TRUE" ]; then
+  MATERIALISE_FLAG="--materialise link"
+fi
+
+# SUBMISSION_STORE=path/to/submissions.sqlite also saves the sorted submissions to a database
+# shared by every assignment.
+if [ ! -z "${SUBMISSION_STORE}" ]; then
+  STORE_FLAG="--store-path ${SUBMISSION_STORE}"
+fi
+
+# NORMALISE=TRUE strips comments and extra whitespace from the files before uploading them.
+if [ "${NORMALISE}" = "TRUE" ]; then
+  NORMALISE_FLAG="--normalise"
+fi
+
 if [ ! -z "${BASE_FILES}" ]; then
   BASE_FILES_FLAG="--base-files ${BASE_FILES}"
 fi
@@ -55,6 +87,12 @@ fi
 MIN_LINES=10
 MIN_SIMILARITY=25
 
+# PROGRESSIVE=TRUE draws the node graph as soon as the report index is downloaded,
+# instead of waiting for every match page.
+if [ "${PROGRESSIVE}" = "TRUE" ]; then
+  PROGRESSIVE_FLAG="--graph-output ./moss_network.html ${FORCE_FLAG}"
+fi
+
 # opens the browser automatically to show MOSS report and node graph.
 OPEN_BROWSER="TRUE"
 
@@ -78,14 +116,16 @@ else
   pip install -r ${_SCRIPT_DIR}/requirements.txt
 fi
 
-python3 ${_SCRIPT_DIR}/sort_submissions_gradescope.py -d "${DUE_DATE}" ${FORCE_FLAG}
+python3 ${_SCRIPT_DIR}/sort_submissions_gradescope.py -d "${DUE_DATE}" ${FORCE_FLAG} ${MATERIALISE_FLAG} ${EXPORT_FLAG} ${STORE_FLAG}
 status=$?
 if [ $status -ne 0 ]; then
   echo "Sorting submissions failed. Exiting."
   exit 1
 fi
 
-REPORT_GEN_OUTPUT="$(python3 ${_SCRIPT_DIR}/submit_to_moss.py --userid ${USERID} ${BROWSER_FLAG} ${BASE_FILES_FLAG})"
+# only the match pages of pairs that will appear in the graph are downloaded,
+# the other pairs in the report link to the MOSS server.
+REPORT_GEN_OUTPUT="$(python3 ${_SCRIPT_DIR}/submit_to_moss.py --userid ${USERID} --min-similarity $MIN_SIMILARITY --min-lines-matched $MIN_LINES ${BROWSER_FLAG} ${BASE_FILES_FLAG} ${INCREMENTAL_FLAG} ${MOSS_SERVER_FLAG} ${PROGRESSIVE_FLAG} ${NORMALISE_FLAG})"
 
 status=$?
 if [ $status -eq 0 ]; then
@@ -98,7 +138,9 @@ else
   exit 1
 fi
 
-python3 ${_SCRIPT_DIR}/moss_nodes.py $report --min-similarity $MIN_SIMILARITY --min-lines-matched $MIN_LINES $BROWSER_FLAG $FORCE_FLAG
+if [ -z "${PROGRESSIVE_FLAG}" ]; then
+  python3 ${_SCRIPT_DIR}/moss_nodes.py $report --min-similarity $MIN_SIMILARITY --min-lines-matched $MIN_LINES $BROWSER_FLAG $FORCE_FLAG
+fi
 
 # deactive venv
 deactivate
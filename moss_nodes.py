@@ -8,6 +8,8 @@ import argparse
 import os
 import webbrowser
 import hashlib
+import csv
+import zipfile
 
 
 # DEPENDENCIES:
@@ -35,7 +37,8 @@ MAX_STRENGTH_SCALE = 100.0
 
 
 def parse_moss_report(html_content, anonymize_names=False):
-    soup = BeautifulSoup(html_content, "html.parser")
+    # lxml closes the <TR>/<TD> tags that MOSS leaves open
+    soup = BeautifulSoup(html_content, "lxml")
     rows = soup.find_all("tr")[1:]  # Skip the header row
 
     edges = []
@@ -54,8 +57,8 @@ def parse_moss_report(html_content, anonymize_names=False):
             fn1 = file1.split(" ")[0].split("/")[-2]
             fn2 = file2.split(" ")[0].split("/")[-2]
             if anonymize_names:
-                fn1 = str(hashlib.sha256(fn1.encode("utf-8")).hexdigest()[:6])
-                fn2 = str(hashlib.sha256(fn2.encode("utf-8")).hexdigest()[:6])
+                fn1 = anonymize(fn1)
+                fn2 = anonymize(fn2)
 
             edges.append((fn1, fn2, sim_percentage1, sim_percentage2, lines_matched))
 
@@ -68,6 +71,50 @@ def parse_moss_report(html_content, anonymize_names=False):
     return edges, node_strength
 
 
+def anonymize(name):
+    return str(hashlib.sha256(name.encode("utf-8")).hexdigest()[:6])
+
+
+# Load the duplicates.csv written by 'submit_to_moss.py'. Duplicate submissions are
+# not uploaded to MOSS, so they are added back here as 100% matches with their
+# representative, and inherit every match the representative has in the report.
+def add_duplicates(csv_content, edges, node_strength, anonymize_names=False):
+    duplicates = [
+        (row["Representative"], row["Duplicate"], int(row["Lines"]))
+        for row in csv.DictReader(csv_content.splitlines())
+    ]
+
+    copies = {}
+    lines_of = {}
+    for representative, duplicate, lines in duplicates:
+        if anonymize_names:
+            representative = anonymize(representative)
+            duplicate = anonymize(duplicate)
+        copies.setdefault(representative, []).append(duplicate)
+        lines_of[duplicate] = lines
+
+    for fn1, fn2, sim1, sim2, lines in list(edges):
+        for copy1 in [fn1] + copies.get(fn1, []):
+            for copy2 in [fn2] + copies.get(fn2, []):
+                if (copy1, copy2) != (fn1, fn2):
+                    edges.append((copy1, copy2, sim1, sim2, lines))
+
+    # every member of a group of identical submissions matches every other member
+    for representative, group in copies.items():
+        members = [representative] + group
+        for i, fn1 in enumerate(members):
+            for fn2 in members[i + 1 :]:
+                edges.append((fn1, fn2, 100, 100, lines_of[fn2]))
+
+    node_strength.clear()
+    for fn1, fn2, sim1, sim2, _ in edges:
+        mean_sim = (sim1 + sim2) / 2.0
+        node_strength[fn1] = node_strength.get(fn1, 0.0) + mean_sim
+        node_strength[fn2] = node_strength.get(fn2, 0.0) + mean_sim
+
+    return edges, node_strength
+
+
 def create_graph(edges, node_strength, min_similarity=10, min_lines_matched=50):
     net = Network(
         # notebook=True,
@@ -135,6 +182,24 @@ def create_graph(edges, node_strength, min_similarity=10, min_lines_matched=50):
 
 # Load the MOSS report from an HTML file
 def load_moss_report(file_path):
+    return load_report_file(file_path, os.path.basename(file_path))
+
+
+# Read the file called name from the report that report_path belongs to. The report is
+# either a directory, with report_path a file in it, or a zip archive
+# ('submit_to_moss.py --archive'). Returns None if the report has no such file.
+def load_report_file(report_path, name):
+    if report_path.endswith(".zip"):
+        with zipfile.ZipFile(report_path) as archive:
+            if name.endswith(".zip"):
+                name = "index.html"
+            if name not in archive.namelist():
+                return None
+            return archive.read(name).decode("utf-8", errors="replace")
+
+    file_path = os.path.join(os.path.dirname(report_path), name)
+    if not os.path.isfile(file_path):
+        return None
     with open(file_path, "r", encoding="utf-8") as file:
         return file.read()
 
@@ -149,7 +214,7 @@ def main():
         "--report",
         type=str,
         default="./moss_report/index.html",
-        help="Path to the MOSS report index.html file.",
+        help="Path to the MOSS report index.html file, or to a report archive made with 'submit_to_moss.py --archive'.",
     )
     parser.add_argument(
         "-o",
@@ -173,6 +238,14 @@ def main():
         help="Minimum lines matched for edges",
     )
 
+    parser.add_argument(
+        "-d",
+        "--duplicates",
+        type=str,
+        default=None,
+        help="Path to the duplicates.csv written by submit_to_moss.py. Defaults to the duplicates.csv in the report directory or archive, if it exists.",
+    )
+
     parser.add_argument(
         "-z",
         "--anonymize-names",
@@ -220,28 +293,60 @@ def main():
         )
         sys.exit(1)
 
+    build_graph(
+        args.report,
+        args.output,
+        args.min_similarity,
+        args.min_lines_matched,
+        args.anonymize_names,
+        args.duplicates,
+        args.show_buttons,
+        args.open_browser,
+    )
+
+
+# Build the graph of the report at report_path and save it to output.
+# Also used by 'submit_to_moss.py' to draw the graph as soon as index.html is downloaded.
+def build_graph(
+    report_path,
+    output,
+    min_similarity=25,
+    min_lines_matched=20,
+    anonymize_names=False,
+    duplicates=None,
+    show_buttons=False,
+    open_browser=False,
+):
     # Load MOSS report and create graph
-    html_content = load_moss_report(args.report)
-    edges, node_strength = parse_moss_report(html_content, args.anonymize_names)
+    html_content = load_moss_report(report_path)
+    edges, node_strength = parse_moss_report(html_content, anonymize_names)
+
+    if duplicates is None:
+        duplicates_csv = load_report_file(report_path, "duplicates.csv")
+    else:
+        duplicates_csv = load_report_file(duplicates, os.path.basename(duplicates))
+    if duplicates_csv is not None:
+        print("adding exact duplicate submissions")
+        edges, node_strength = add_duplicates(
+            duplicates_csv, edges, node_strength, anonymize_names
+        )
 
     print(
-        f"creating graph with min_similarity={args.min_similarity} and min_lines_matched={args.min_lines_matched}"
+        f"creating graph with min_similarity={min_similarity} and min_lines_matched={min_lines_matched}"
     )
 
-    net = create_graph(
-        edges, node_strength, args.min_similarity, args.min_lines_matched
-    )
+    net = create_graph(edges, node_strength, min_similarity, min_lines_matched)
 
-    if args.show_buttons:
+    if show_buttons:
         net.show_buttons()
 
     # Save and visualize the network
-    net.save_graph(args.output)
-    print(f"Interactive graph saved to: {args.output}")
+    net.save_graph(output)
+    print(f"Interactive graph saved to: {output}")
 
-    if args.open_browser:
+    if open_browser:
         print("Opening the generated network in web browser...")
-        webbrowser.open_new_tab(args.output)
+        webbrowser.open_new_tab(output)
 
 
 # Entry point for the script
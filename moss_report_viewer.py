@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+# Serve a MOSS report archive made with 'submit_to_moss.py --archive' to a web browser,
+# reading each page straight out of the zip file without extracting it.
+
+# for usage:
+# python3 moss_report_viewer.py --help
+
+# example:
+# python3 moss_report_viewer.py moss_report.zip --open-browser
+
+import argparse
+import mimetypes
+import os
+import sys
+import webbrowser
+import zipfile
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+
+class ArchiveRequestHandler(BaseHTTPRequestHandler):
+    def __init__(self, archive, *args, **kwargs):
+        self.archive = archive
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        # links in the report are already rewritten to the page names in the archive
+        name = unquote(urlsplit(self.path).path).lstrip("/") or "index.html"
+        try:
+            content = self.archive.read(name)
+        except KeyError:
+            self.send_error(404, f"{name} is not in the report")
+            return
+
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve a MOSS report archive made with 'submit_to_moss.py --archive'.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "archive",
+        type=str,
+        nargs="?",
+        default="./moss_report.zip",
+        help="Path to the report archive.",
+    )
+    parser.add_argument(
+        "-p", "--port", type=int, default=8000, help="Port to serve the report on."
+    )
+    parser.add_argument(
+        "--open-browser",
+        action="store_true",
+        default=False,
+        help="If set, open the report in a browser.",
+    )
+
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.archive) or not zipfile.is_zipfile(args.archive):
+        print(f"No report archive found at {args.archive}.")
+        sys.exit(1)
+
+    # ZipFile looks pages up in the central directory and reads them with random access
+    archive = zipfile.ZipFile(args.archive)
+    server = ThreadingHTTPServer(
+        ("localhost", args.port), partial(ArchiveRequestHandler, archive)
+    )
+    url = f"http://localhost:{server.server_address[1]}/index.html"
+    print(f"Serving {args.archive} at {url}, press Ctrl-C to stop.")
+
+    if args.open_browser:
+        webbrowser.open(url)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        archive.close()
+
+
+if __name__ == "__main__":
+    main()
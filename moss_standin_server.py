@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+# A local stand-in for moss.stanford.edu, for testing and benchmarking
+# 'submit_to_moss.py' without a MOSS userid or network access.
+
+# for usage:
+# python3 moss_standin_server.py --help
+
+# It speaks the same line protocol as the real server
+# (moss, directory, X, maxmatches, show, language, file ..., query, end) and serves
+# a MOSS-like report over http, so the report download can be tested as well.
+# Similarity in the report is the fraction of shared (whitespace-normalised) lines,
+# which is nothing like MOSS's algorithm but good enough to produce a plausible report.
+
+# Network conditions can be simulated with --latency, --bandwidth, --read-size and
+# --drop-after, and the bytes and timings received for every query are printed
+# (and appended to --stats-path as json lines if set).
+
+# example:
+# python3 moss_standin_server.py --port 7690 --bandwidth 1000000 &
+# python3 submit_to_moss.py --userid 1 --moss-server localhost:7690
+
+import argparse
+import asyncio
+import html
+import itertools
+import json
+import time
+from collections import Counter
+
+# same as Moss.languages in submit_to_moss.py
+LANGUAGES = (
+    "c",
+    "cc",
+    "java",
+    "ml",
+    "pascal",
+    "ada",
+    "lisp",
+    "scheme",
+    "haskell",
+    "fortran",
+    "ascii",
+    "vhdl",
+    "verilog",
+    "perl",
+    "matlab",
+    "python",
+    "mips",
+    "prolog",
+    "spice",
+    "vb",
+    "csharp",
+    "modula2",
+    "a8086",
+    "javascript",
+    "plsql",
+)
+
+
+class StandinServer:
+    def __init__(
+        self,
+        host="localhost",
+        http_port=0,
+        latency=0.0,
+        bandwidth=0,
+        read_size=64 * 1024,
+        drop_after=0,
+        stats_path=None,
+    ):
+        self.host = host
+        self.http_port = http_port
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.read_size = read_size
+        self.drop_after = drop_after
+        self.stats_path = stats_path
+        # report id -> {page name: html}
+        self.reports = {}
+        self.report_ids = itertools.count(1)
+
+    async def readBody(self, reader, size, received):
+        # read a file body the way a slow or throttled server would
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            chunk = await reader.read(min(self.read_size, remaining))
+            if not chunk:
+                raise ConnectionError("client closed the connection mid-file")
+            chunks.append(chunk)
+            remaining -= len(chunk)
+            received[0] += len(chunk)
+            if self.drop_after and received[0] >= self.drop_after:
+                raise ConnectionError(f"dropping connection after {received[0]} bytes")
+            if self.bandwidth:
+                await asyncio.sleep(len(chunk) / self.bandwidth)
+        return b"".join(chunks)
+
+    async def handleMoss(self, reader, writer):
+        options = {}
+        files = []
+        received = [0]
+        start = time.perf_counter()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                received[0] += len(line)
+                command, _, rest = line.decode().rstrip("\n").partition(" ")
+
+                if command == "language":
+                    options["l"] = rest
+                    writer.write(b"yes\n" if rest in LANGUAGES else b"no\n")
+                    await writer.drain()
+                elif command == "file":
+                    file_id, language, size, name = rest.split(" ", 3)
+                    file_start = time.perf_counter()
+                    body = await self.readBody(reader, int(size), received)
+                    files.append(
+                        {
+                            "id": int(file_id),
+                            "name": name,
+                            "size": int(size),
+                            "seconds": time.perf_counter() - file_start,
+                            "body": body,
+                        }
+                    )
+                elif command == "query":
+                    await asyncio.sleep(self.latency)
+                    url = self.makeReport(options, files)
+                    writer.write(f"{url}\n".encode())
+                    await writer.drain()
+                    self.recordStats(options, files, received[0], start)
+                elif command == "end":
+                    break
+                else:
+                    options[command] = rest
+        except ConnectionError as e:
+            print(f"connection dropped: {e}")
+        finally:
+            writer.close()
+
+    def recordStats(self, options, files, received, start):
+        seconds = time.perf_counter() - start
+        stats = {
+            "user": options.get("moss"),
+            "files": len(files),
+            "bytes": received,
+            "seconds": seconds,
+            "bytes_per_second": received / seconds if seconds > 0 else 0.0,
+            "slowest_file": (
+                max(files, key=lambda f: f["seconds"])["name"] if files else None
+            ),
+        }
+        print(json.dumps(stats))
+        if self.stats_path:
+            with open(self.stats_path, "a") as f:
+                f.write(json.dumps(stats) + "\n")
+
+    def makeReport(self, options, files):
+        report_id = next(self.report_ids)
+        base_url = f"http://{self.host}:{self.http_port}/results/{report_id}"
+
+        base_lines = set()
+        submissions = {}
+        for f in files:
+            lines = f["body"].decode(errors="replace").splitlines()
+            if f["id"] == 0:
+                base_lines.update(" ".join(line.split()) for line in lines)
+                continue
+            # in directory mode every file in a directory is one submission
+            name = f["name"]
+            if options.get("directory", "0") == "1":
+                name = name.rsplit("/", 1)[0] + "/"
+            submissions.setdefault(name, []).extend(lines)
+
+        normalised = {
+            name: {" ".join(line.split()) for line in lines} - base_lines - {""}
+            for name, lines in submissions.items()
+        }
+        # like MOSS, lines shared by more than maxmatches submissions are ignored,
+        # which also keeps this from comparing every pair in large cohorts.
+        max_matches = int(options.get("maxmatches", 10))
+        postings = {}
+        for name, lines in normalised.items():
+            for line in lines:
+                postings.setdefault(line, []).append(name)
+        shared = Counter()
+        for names in postings.values():
+            if 1 < len(names) <= max_matches:
+                shared.update(itertools.combinations(names, 2))
+
+        matches = []
+        for (name1, name2), n_shared in shared.items():
+            pct1 = round(100 * n_shared / len(normalised[name1]))
+            pct2 = round(100 * n_shared / len(normalised[name2]))
+            matches.append((n_shared, name1, pct1, name2, pct2))
+        matches.sort(reverse=True)
+        matches = matches[: int(options.get("show", 250))]
+
+        pages = {}
+        rows = []
+        for i, (lines, name1, pct1, name2, pct2) in enumerate(matches):
+            match = f"{base_url}/match{i}.html"
+            rows.append(
+                f'<TR><TD><A HREF="{match}">{html.escape(name1)} ({pct1}%)</A>\n'
+                f'    <TD><A HREF="{match}">{html.escape(name2)} ({pct2}%)</A>\n'
+                f"<TD ALIGN=right>{lines}\n"
+            )
+            pages[f"match{i}.html"] = (
+                f"<HTML><HEAD><TITLE>Matches for {html.escape(name1)} and {html.escape(name2)}</TITLE></HEAD>\n"
+                f'<FRAMESET ROWS="150,*"><FRAMESET COLS="1000,*"><FRAME SRC="match{i}-top.html" NAME="top"></FRAMESET>\n'
+                f'<FRAMESET COLS="50%,50%"><FRAME SRC="match{i}-0.html" NAME="0"><FRAME SRC="match{i}-1.html" NAME="1"></FRAMESET></FRAMESET></HTML>\n'
+            )
+            pages[f"match{i}-top.html"] = (
+                f"<HTML><BODY><CENTER><TABLE><TR><TH>{html.escape(name1)} ({pct1}%)<TH>{html.escape(name2)} ({pct2}%)\n"
+                f'<TR><TD><A HREF="match{i}-0.html#0" TARGET="0">1-{lines}</A>'
+                f'<TD><A HREF="match{i}-1.html#0" TARGET="1">1-{lines}</A>\n'
+                f"</TABLE></CENTER></BODY></HTML>\n"
+            )
+            for side, name in ((0, name1), (1, name2)):
+                code = html.escape("\n".join(submissions[name]))
+                pages[f"match{i}-{side}.html"] = (
+                    f"<HTML><BODY BGCOLOR=white><HR>{html.escape(name)}<P><PRE>\n"
+                    f'<A NAME="0"></A><A HREF="match{i}-{1 - side}.html#0" TARGET="{1 - side}">match</A>\n'
+                    f"{code}\n</PRE></BODY></HTML>\n"
+                )
+
+        pages["index.html"] = (
+            "<HTML><HEAD><TITLE>Moss Results</TITLE></HEAD><BODY>\n"
+            "<TABLE>\n<TR><TH>File 1<TH>File 2<TH>Lines Matched\n"
+            + "".join(rows)
+            + "</TABLE></BODY></HTML>\n"
+        )
+        self.reports[str(report_id)] = pages
+        return base_url
+
+    async def handleHttp(self, reader, writer):
+        # minimal HTTP/1.1 server with keep-alive, enough for download_report
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                keep_alive = request_line.rstrip().endswith(b"HTTP/1.1")
+                while True:
+                    header = await reader.readline()
+                    if header in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = header.decode().partition(":")
+                    if name.strip().lower() == "connection":
+                        keep_alive = value.strip().lower() == "keep-alive"
+
+                parts = (
+                    request_line.decode().split()[1].split("?")[0].strip("/").split("/")
+                )
+                page = None
+                if (
+                    len(parts) >= 2
+                    and parts[0] == "results"
+                    and parts[1] in self.reports
+                ):
+                    name = parts[2] if len(parts) > 2 and parts[2] else "index.html"
+                    page = self.reports[parts[1]].get(name)
+
+                if page is None:
+                    status, body = "404 Not Found", b"not found\n"
+                else:
+                    status, body = "200 OK", page.encode()
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                writer.write(
+                    (
+                        f"HTTP/1.1 {status}\r\n"
+                        "Content-Type: text/html; charset=utf-8\r\n"
+                        f"Content-Length: {len(body)}\r\n"
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                    ).encode()
+                    + body
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, port):
+        http_server = await asyncio.start_server(
+            self.handleHttp, self.host, self.http_port
+        )
+        self.http_port = http_server.sockets[0].getsockname()[1]
+        moss_server = await asyncio.start_server(self.handleMoss, self.host, port)
+        print(
+            f"MOSS stand-in listening on {self.host}:{moss_server.sockets[0].getsockname()[1]}, reports at http://{self.host}:{self.http_port}/results/",
+            flush=True,
+        )
+        async with http_server, moss_server:
+            await asyncio.gather(
+                http_server.serve_forever(), moss_server.serve_forever()
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Local stand-in for the MOSS server, for testing and benchmarking submit_to_moss.py.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--host", type=str, default="localhost", help="Host to listen on."
+    )
+    parser.add_argument(
+        "-p", "--port", type=int, default=7690, help="Port for the MOSS protocol."
+    )
+    parser.add_argument(
+        "--http-port",
+        type=int,
+        default=0,
+        help="Port to serve reports on. 0 picks a free port.",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="Seconds to wait before answering a query or an http request.",
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=int,
+        default=0,
+        help="Limit uploads to this many bytes per second. 0 is unlimited.",
+    )
+    parser.add_argument(
+        "--read-size",
+        type=int,
+        default=64 * 1024,
+        help="Read file bodies at most this many bytes at a time, to simulate partial reads.",
+    )
+    parser.add_argument(
+        "--drop-after",
+        type=int,
+        default=0,
+        help="Drop every connection after receiving this many bytes. 0 never drops.",
+    )
+    parser.add_argument(
+        "--stats-path",
+        type=str,
+        default=None,
+        help="Append the upload statistics of every query to this file as json lines.",
+    )
+
+    args = parser.parse_args()
+
+    server = StandinServer(
+        args.host,
+        args.http_port,
+        args.latency,
+        args.bandwidth,
+        args.read_size,
+        args.drop_after,
+        args.stats_path,
+    )
+    try:
+        asyncio.run(server.serve(args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,26 @@
 #!/usr/bin/env python3
 
+from __future__ import annotations
+
 import os
 from datetime import datetime, timedelta, timezone
-import glob
+import fnmatch
 import csv
+import hashlib
+import io
+import json
+import posixpath
+import re
+import sqlite3
+import time
+import zipfile
 from dataclasses import dataclass
 import shutil
 import argparse
 import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 
 ##################
 ### QUICKSTART ###
@@ -26,15 +39,896 @@ import sys
 ##################
 ### PARAMETERS ###
 ##################
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S %z"
+
+# print a progress line every this many metadata rows
+PROGRESS_ROWS = 10000
+
+
+# slotted, as a large export has one of these per submission
 @dataclass
 class Submission:
+    __slots__ = (
+        "id",
+        "names",
+        "student_ids",
+        "submitted_datetime",
+        "code_files",
+        "pdf_files",
+        "overdue_hrs",
+        "question",
+        "oversized_files",
+    )
     id: str
     names: list[str]
     student_ids: list[str]
     submitted_datetime: datetime
-    code_files: list[str]
-    pdf_files: list[str]
+    # tuples, as they don't change and the empty tuple is shared
+    code_files: tuple[str, ...]
+    pdf_files: tuple[str, ...]
     overdue_hrs: float
+    # the question number with --per-question, otherwise empty
+    question: str
+    # "path (reason: action)" for every code file caught by the size and binary guards
+    oversized_files: tuple[str, ...]
+
+
+@dataclass
+class DiscoveredFile:
+    path: str
+    size: int
+    mtime: float
+    inode: int
+    category: str
+
+
+# columns of the discovery manifest written next to the processed csv
+MANIFEST_COLUMNS = [
+    "Submission ID",
+    "Category",
+    "Path",
+    "Sorted Path",
+    "Size",
+    "Mtime",
+    "Inode",
+    "Question",
+    # the size of the sorted file, empty when it is not a copy of the original,
+    # eg. a converted notebook
+    "Sorted Size",
+    # how a file over the limits was cut down, so changing the limits or the
+    # oversize action writes it again
+    "Guard",
+]
+
+QUESTION_COLUMN = re.compile(r"Question (\d+) Submitted At")
+# a Response maps the answer boxes of a question to the files uploaded to them, eg.
+# {"0"=>[{"text_file_id"=>674791352}], "1"=>[{"text_file_id"=>674791353}]}
+RESPONSE_FILE_ID = re.compile(r'"\w*file_id"=>(\d+)')
+# and each file is exported as eg. text_file_674791353-decomp_solve_skeleton.py
+FILE_NAME_ID = re.compile(r"(?:text_)?file_(\d+)-")
+
+
+def submission_key(submission_id: str, question: str) -> str:
+    return f"{submission_id}/Q{question}" if question else submission_id
+
+
+def route_files(
+    files: list[DiscoveredFile], responses: dict[str, str]
+) -> tuple[dict[str, list[DiscoveredFile]], list[DiscoveredFile]]:
+    """
+    Split the files of a submission between the questions whose Response lists their
+    file id. Returns ({question: files}, files that could not be matched). With a
+    single question every file belongs to it.
+    """
+    file_questions = {
+        file_id: question
+        for question, response in responses.items()
+        for file_id in RESPONSE_FILE_ID.findall(response)
+    }
+    routed: dict[str, list[DiscoveredFile]] = {question: [] for question in responses}
+    unrouted = []
+    for f in files:
+        file_id = FILE_NAME_ID.match(os.path.basename(f.path))
+        question = file_questions.get(file_id.group(1)) if file_id else None
+        if question is None and len(responses) == 1:
+            question = next(iter(responses))
+        if question is None:
+            unrouted.append(f)
+        else:
+            routed[question].append(f)
+    return routed, unrouted
+
+
+@lru_cache(maxsize=None)
+def parse_utc_offset(offset: str) -> timezone:
+    sign = -1 if offset[0] == "-" else 1
+    return timezone(sign * timedelta(hours=int(offset[1:3]), minutes=int(offset[3:5])))
+
+
+def parse_datetime(value: str) -> datetime:
+    """
+    Parse a timestamp in DATETIME_FORMAT, eg. '2024-10-02 01:02:29 -0700'.
+    datetime.fromisoformat parses the date and time much faster than strptime,
+    and an export only has a few distinct utc offsets, so they are cached.
+    """
+    if len(value) == 25 and value[19] == " " and value[20] in "+-":
+        return datetime.fromisoformat(value[:19]).replace(
+            tzinfo=parse_utc_offset(value[20:])
+        )
+    return datetime.strptime(value, DATETIME_FORMAT)
+
+
+def read_submission_metadata(
+    metadata_path: str,
+    due_datetime: datetime,
+    overdue_leniency: timedelta,
+    discovered: dict[str, list[DiscoveredFile]],
+    verbose: bool = False,
+    archive: zipfile.ZipFile | None = None,
+    per_question: bool = False,
+    guarded: dict[str, tuple[str, str]] | None = None,
+) -> dict[str, Submission]:
+    """
+    Stream the rows of submission_metadata.csv (a member of archive, if given) into
+    one Submission per submission id, with the files discovered for it. Students in
+    a group share a submission. With per_question, there is one Submission per
+    question answered instead, keyed by submission_key, with the files uploaded to
+    that question and its own submission time. Code files in guarded, as
+    {path: (reason, action)}, are listed in oversized_files, and left out of the
+    code files if they were skipped.
+    """
+    tz_local = due_datetime.tzinfo
+    guarded = guarded or {}
+    submissions: dict[str, Submission] = {}
+    # submission id -> the names and ids shared by its questions, with per_question
+    groups: dict[str, tuple[list[str], list[str]]] = {}
+    n_rows = 0
+    n_missing = 0
+    n_unrouted = 0
+
+    def new_submission(
+        submission_id, question, names, student_ids, submitted_at, files
+    ):
+        submission_datetime = parse_datetime(submitted_at).astimezone(tz_local)
+        overdue_hrs = 0
+        if (submission_datetime - due_datetime) > overdue_leniency:
+            overdue_hrs = (
+                submission_datetime - (due_datetime + overdue_leniency)
+            ) / timedelta(hours=1)
+        submissions[submission_key(submission_id, question)] = Submission(
+            id=submission_id,
+            names=names,
+            student_ids=student_ids,
+            submitted_datetime=submission_datetime,
+            code_files=tuple(
+                f.path
+                for f in files
+                if f.category == "code"
+                and guarded.get(f.path, ("", ""))[1] != "skipped"
+            ),
+            pdf_files=tuple(f.path for f in files if f.category == "pdf"),
+            overdue_hrs=overdue_hrs,
+            question=question,
+            oversized_files=tuple(
+                "{} ({}: {})".format(f.path, *guarded[f.path])
+                for f in files
+                if f.category == "code" and f.path in guarded
+            ),
+        )
+
+    if archive is not None:
+        metadata_csv = io.TextIOWrapper(
+            archive.open(metadata_path), encoding="utf-8", newline=""
+        )
+    else:
+        metadata_csv = open(metadata_path, "r", newline="")
+    with metadata_csv:
+        metadata_reader = csv.reader(metadata_csv)
+        columns = {name: i for i, name in enumerate(next(metadata_reader))}
+        status_col = columns["Status"]
+        submission_id_col = columns["Submission ID"]
+        first_name_col = columns["First Name"]
+        last_name_col = columns["Last Name"]
+        student_id_col = columns["Student ID"]
+        submitted_at_col = columns["Question 1 Submitted At"]
+        questions = {}
+        if per_question:
+            # question -> (submitted at column, response column)
+            for name, i in columns.items():
+                question = QUESTION_COLUMN.fullmatch(name)
+                if question is not None:
+                    number = question.group(1)
+                    if f"Question {number} Response" not in columns:
+                        print(
+                            f"{metadata_path} has no 'Question {number} Response' column, so the files of question {number} cannot be told apart. Export the submissions with their responses, or sort without --per-question."
+                        )
+                        sys.exit(1)
+                    questions[number] = (i, columns[f"Question {number} Response"])
+
+        for row in metadata_reader:
+            n_rows += 1
+            if n_rows % PROGRESS_ROWS == 0:
+                print(f"Read {n_rows} rows, {len(submissions)} submissions so far.")
+
+            if row[status_col] == "Missing":
+                n_missing += 1
+                continue
+
+            submission_id = row[submission_id_col]
+            student_name = row[first_name_col] + " " + row[last_name_col]
+            student_id = row[student_id_col]
+
+            # the other members of a group come after the first one
+            group = groups.get(submission_id) if per_question else None
+            submission = None if per_question else submissions.get(submission_id)
+            if group is not None or submission is not None:
+                if verbose:
+                    print(
+                        f"Adding {student_name} to existing submission: {submission_id}"
+                    )
+                names, student_ids = (
+                    group if group else (submission.names, submission.student_ids)
+                )
+                names.append(student_name)
+                student_ids.append(student_id)
+                continue
+
+            if verbose:
+                print(f"Adding new submission for student {student_name}")
+            files = discovered.get(submission_id, [])
+            if not per_question:
+                new_submission(
+                    submission_id,
+                    "",
+                    [student_name],
+                    [student_id],
+                    row[submitted_at_col],
+                    files,
+                )
+                continue
+
+            # questions share the list of names, so group members are added once
+            group = groups[submission_id] = ([student_name], [student_id])
+            routed, unrouted = route_files(
+                files,
+                {
+                    question: row[response_col]
+                    for question, (_, response_col) in questions.items()
+                },
+            )
+            n_unrouted += len(unrouted)
+            for question, (submitted_col, _) in questions.items():
+                # questions that were not answered have no submission time
+                if row[submitted_col]:
+                    new_submission(
+                        submission_id,
+                        question,
+                        *group,
+                        row[submitted_col],
+                        routed[question],
+                    )
+
+    n_students = sum(len(names) for names, _ in groups.values()) or sum(
+        len(submission.names) for submission in submissions.values()
+    )
+    print(
+        f"Read {n_rows} rows: {len(submissions)} submissions from {n_students} students, {n_missing} missing."
+    )
+    if n_unrouted:
+        print(
+            f"WARNING: {n_unrouted} files are not in the Response of any question and were left out."
+        )
+    return submissions
+
+
+def glob_match(name: str, pattern: str) -> bool:
+    # same as glob.glob on a single directory, which skips hidden files unless asked.
+    # Several patterns can be separated by commas.
+    return any(
+        fnmatch.fnmatchcase(name, p)
+        for p in pattern.split(",")
+        if not name.startswith(".") or p.startswith(".")
+    )
+
+
+def discover_submission_files(
+    assignment_files_directory: str,
+    code_file_match_pattern: str,
+    pdf_file_match_pattern: str,
+) -> dict[str, list[DiscoveredFile]]:
+    """
+    List the code and pdf files of every submission_* directory in one os.scandir pass,
+    which stats each matching file once. Returns {submission id: files}.
+    """
+    discovered: dict[str, list[DiscoveredFile]] = {}
+    with os.scandir(assignment_files_directory) as entries:
+        for entry in entries:
+            if not entry.name.startswith("submission_") or not entry.is_dir():
+                continue
+            files = []
+            with os.scandir(entry.path) as submission_entries:
+                for file in submission_entries:
+                    categories = [
+                        category
+                        for category, pattern in (
+                            ("code", code_file_match_pattern),
+                            ("pdf", pdf_file_match_pattern),
+                        )
+                        if glob_match(file.name, pattern)
+                    ]
+                    if not categories:
+                        continue
+                    stat = file.stat()
+                    for category in categories:
+                        files.append(
+                            DiscoveredFile(
+                                path=file.path,
+                                size=stat.st_size,
+                                mtime=stat.st_mtime,
+                                inode=stat.st_ino,
+                                category=category,
+                            )
+                        )
+            discovered[entry.name[len("submission_") :]] = files
+    return discovered
+
+
+def export_root(archive: zipfile.ZipFile, metadata_name: str) -> str:
+    # exports usually have everything in a single top level directory
+    candidates = [
+        name for name in archive.namelist() if posixpath.basename(name) == metadata_name
+    ]
+    if not candidates:
+        raise FileNotFoundError(f"{metadata_name} not found in {archive.filename}")
+    return posixpath.dirname(min(candidates, key=len))
+
+
+def zip_mtime(info: zipfile.ZipInfo) -> float:
+    return time.mktime((*info.date_time, 0, 0, -1))
+
+
+def discover_archive_files(
+    archive: zipfile.ZipFile,
+    root: str,
+    code_file_match_pattern: str,
+    pdf_file_match_pattern: str,
+) -> dict[str, list[DiscoveredFile]]:
+    """
+    Same as discover_submission_files, for an export zip. The files are found in the
+    central directory of the archive, so nothing is extracted or statted. Paths are
+    the archive's path followed by the member name.
+    """
+    prefix = root + "/" if root else ""
+    discovered: dict[str, list[DiscoveredFile]] = {}
+    for info in archive.infolist():
+        if info.is_dir() or not info.filename.startswith(prefix):
+            continue
+        parts = info.filename[len(prefix) :].split("/")
+        if len(parts) != 2 or not parts[0].startswith("submission_"):
+            continue
+        files = discovered.setdefault(parts[0][len("submission_") :], [])
+        for category, pattern in (
+            ("code", code_file_match_pattern),
+            ("pdf", pdf_file_match_pattern),
+        ):
+            if glob_match(parts[1], pattern):
+                files.append(
+                    DiscoveredFile(
+                        path=f"{archive.filename}/{info.filename}",
+                        size=info.file_size,
+                        mtime=zip_mtime(info),
+                        # members have no inode, their crc identifies the contents
+                        inode=info.CRC,
+                        category=category,
+                    )
+                )
+    return discovered
+
+
+def extract_file(archive: zipfile.ZipFile, src: str, dst: str) -> str:
+    info = archive.getinfo(src[len(archive.filename) + 1 :])
+    with archive.open(info) as fsrc, open(dst, "wb") as fdst:
+        shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+    mtime = zip_mtime(info)
+    os.utime(dst, (mtime, mtime))
+    return "extracted"
+
+
+# ioctl request that makes one file share the extents of another (linux/fs.h)
+FICLONE = 0x40049409
+
+
+def reflink_file(src: str, dst: str) -> str:
+    # FICLONE shares the extents on filesystems with reflinks (btrfs, xfs). Where it is
+    # not supported, copy_file_range copies server-side on nfs, and otherwise copies
+    # in the kernel, which saves no space, so it is reported as a copy.
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            import fcntl
+
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            method = "reflinked"
+        except (ImportError, OSError):
+            remaining = os.fstat(fsrc.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+            method = "copied (in-kernel)"
+    shutil.copystat(src, dst)
+    return method
+
+
+def symlink_file(src: str, dst: str) -> None:
+    os.symlink(os.path.abspath(src), dst)
+
+
+def materialise_file(
+    src: str,
+    dst: str,
+    materialise: str,
+    replace: bool = False,
+    archive: zipfile.ZipFile | None = None,
+) -> str:
+    """
+    Make dst a copy of src. In "link" mode try a hardlink, a reflink and a symlink
+    in that order, falling back to a copy. Files in an export archive are always
+    extracted. Returns how dst was made.
+    """
+    if replace:
+        # never write through an old hardlink into the file it was linked to
+        try:
+            os.remove(dst)
+        except FileNotFoundError:
+            pass
+    if archive is not None:
+        return extract_file(archive, src, dst)
+    if materialise == "link":
+        for method, make in (
+            ("hardlinked", os.link),
+            (None, reflink_file),
+            ("symlinked", symlink_file),
+        ):
+            try:
+                # reflink_file reports whether it could share the extents
+                return make(src, dst) or method
+            except (OSError, AttributeError):
+                # eg. across filesystems, or copy_file_range is not available
+                if os.path.lexists(dst):
+                    os.remove(dst)
+    shutil.copy2(src, dst)
+    return "copied"
+
+
+# how much of each code file is read to tell whether it is binary
+SNIFF_SIZE = 8192
+OVERSIZE_ACTIONS = {"skip": "skipped", "truncate": "truncated", "flag": "flagged"}
+
+
+def guard_file(
+    f: DiscoveredFile,
+    max_size: int,
+    max_line_length: int,
+    archive: zipfile.ZipFile | None = None,
+) -> str | None:
+    """
+    Return why f should not be sent to MOSS as it is: "binary" if its first
+    SNIFF_SIZE bytes have a NUL byte (as git decides), "too large" if it is over
+    max_size bytes, or "long lines" if a line in those bytes is over
+    max_line_length characters, eg. minified code. None if it passes, or a limit
+    is 0.
+    """
+    if archive is not None:
+        fsrc = archive.open(f.path[len(archive.filename) + 1 :])
+    else:
+        fsrc = open(f.path, "rb")
+    with fsrc:
+        head = fsrc.read(SNIFF_SIZE)
+    if b"\0" in head:
+        return "binary"
+    if max_size and f.size > max_size:
+        return "too large"
+    if max_line_length and any(
+        len(line) > max_line_length
+        for line in head.decode("utf-8", errors="replace").split("\n")
+    ):
+        return "long lines"
+    return None
+
+
+def truncate_file(
+    src: str,
+    dst: str,
+    max_size: int,
+    max_line_length: int,
+    replace: bool = False,
+    archive: zipfile.ZipFile | None = None,
+) -> str:
+    """
+    Copy the lines of src that fit in max_size bytes to dst, cutting them to
+    max_line_length bytes, without reading more than one (cut) line at a time.
+    """
+    if replace:
+        # never write through an old hardlink into the file it was linked to
+        try:
+            os.remove(dst)
+        except FileNotFoundError:
+            pass
+    if archive is not None:
+        fsrc = archive.open(src[len(archive.filename) + 1 :])
+    else:
+        fsrc = open(src, "rb")
+    remaining = max_size or float("inf")
+    with fsrc, open(dst, "wb") as fdst:
+        while remaining > 0:
+            line = fsrc.readline(max_line_length + 1 if max_line_length else -1)
+            if not line:
+                break
+            if max_line_length and len(line) > max_line_length:
+                line = line[:max_line_length] + b"\n"
+                # skip the rest of the line
+                while True:
+                    rest = fsrc.readline(SNIFF_SIZE)
+                    if not rest or rest.endswith(b"\n"):
+                        break
+            if len(line) > remaining:
+                # only whole lines are kept
+                break
+            fdst.write(line)
+            remaining -= len(line)
+    return "truncated"
+
+
+NOTEBOOK_SUFFIX = ".ipynb"
+NOTEBOOK_CELLS = re.compile(r'\s*\{\s*"cells"\s*:\s*\[')
+BETWEEN_CELLS = re.compile(r"[\s,]*")
+# the export archive, opened once in each notebook worker process
+worker_archive: zipfile.ZipFile | None = None
+
+
+def sorted_name(file_path: str) -> str:
+    # notebooks are sorted as the python file made of their code cells
+    name = os.path.basename(file_path)
+    return name + ".py" if name.endswith(NOTEBOOK_SUFFIX) else name
+
+
+def without_outputs(pairs: list[tuple[str, object]]) -> dict:
+    # outputs hold images and printed data, which are dropped as soon as they are read
+    return {key: value for key, value in pairs if key not in ("outputs", "attachments")}
+
+
+def notebook_cells(f: io.TextIOBase, chunk_size: int = 1024 * 1024):
+    """
+    Yield the cells of the notebook read from f, decoding one cell at a time so only
+    the largest cell, not the whole notebook, has to fit in memory. Notebooks that
+    do not start with the list of cells (eg. nbformat 3) are read whole.
+    """
+    decoder = json.JSONDecoder(object_pairs_hook=without_outputs)
+    buffer = f.read(chunk_size)
+    cells = NOTEBOOK_CELLS.match(buffer)
+    if cells is None:
+        notebook = json.loads(buffer + f.read(), object_pairs_hook=without_outputs)
+        yield from notebook.get("cells", [])
+        for worksheet in notebook.get("worksheets", []):
+            yield from worksheet.get("cells", [])
+        return
+
+    position = cells.end()
+    eof = False
+    while True:
+        position = BETWEEN_CELLS.match(buffer, position).end()
+        if position < len(buffer):
+            if buffer[position] == "]":
+                return
+            try:
+                cell, position = decoder.raw_decode(buffer, position)
+                yield cell
+                continue
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+        elif eof:
+            raise ValueError("the notebook ends in the middle of its cells")
+        # the next cell is not all in the buffer yet. Reading at least as much again
+        # keeps a large cell from being decoded over and over.
+        more = f.read(max(chunk_size, len(buffer) - position))
+        eof = not more
+        buffer = buffer[position:] + more
+        position = 0
+
+
+def extract_notebook(src: str, dst: str, archive: zipfile.ZipFile | None = None) -> str:
+    """
+    Write the code cells of the notebook src to dst as a python file, starting each
+    cell with a '# %%' marker. IPython magics and shell commands are commented out.
+    """
+    if archive is not None:
+        f = io.TextIOWrapper(
+            archive.open(src[len(archive.filename) + 1 :]), encoding="utf-8"
+        )
+    else:
+        f = open(src, "r", encoding="utf-8")
+    with f, open(dst, "w", encoding="utf-8") as fdst:
+        for i, cell in enumerate(notebook_cells(f)):
+            if cell.get("cell_type") != "code":
+                continue
+            source = cell.get("source", cell.get("input", ""))
+            if isinstance(source, list):
+                source = "".join(source)
+            fdst.write(f"# %% cell {i + 1}\n")
+            for line in source.splitlines():
+                if line.lstrip().startswith(("%", "!")):
+                    line = "# " + line
+                fdst.write(line + "\n")
+            fdst.write("\n")
+    return "converted"
+
+
+def open_worker_archive(archive_path: str | None) -> None:
+    global worker_archive
+    if archive_path is not None:
+        worker_archive = zipfile.ZipFile(archive_path)
+
+
+def materialise_notebook(src: str, dst: str, replace: bool = False) -> str:
+    if replace:
+        try:
+            os.remove(dst)
+        except FileNotFoundError:
+            pass
+    try:
+        return extract_notebook(src, dst, worker_archive)
+    except (ValueError, UnicodeDecodeError, AttributeError, TypeError) as e:
+        # eg. a truncated upload, or json that is not laid out as a notebook (a cell
+        # that is not an object, a source that is not text), which is noted in place
+        # of its code rather than sent as json
+        print(f"WARNING: could not read the notebook {src}: {e}")
+        with open(dst, "w", encoding="utf-8") as fdst:
+            fdst.write(f"# could not read the notebook: {e}\n")
+        return "unreadable"
+
+
+PROCESSED_COLUMNS = [
+    "Submission ID",
+    "Student Names",
+    "Student IDs",
+    "Submitted Datetime",
+    "Overdue Hours",
+    "Code Files",
+    "PDF Files",
+    "Oversized Files",
+]
+
+
+def processed_row(submission: Submission) -> list[str]:
+    # with --per-question, the question is added as the last column
+    return [
+        submission.id,
+        ",".join(submission.names),
+        ",".join(submission.student_ids),
+        submission.submitted_datetime.strftime(DATETIME_FORMAT),
+        str(submission.overdue_hrs),
+        ",".join(submission.code_files),
+        ",".join(submission.pdf_files),
+        ",".join(submission.oversized_files),
+    ] + ([submission.question] if submission.question else [])
+
+
+def read_previous_sort(
+    manifest_path: str, processed_csv_path: str
+) -> tuple[dict[str, tuple[str, str, int, float, int, str]], dict[str, list[str]]]:
+    """
+    Return the sorted files of the previous run, as {sorted path: (submission key,
+    path, size, mtime, inode, guard)}, and its processed csv rows by submission key.
+    """
+    previous_files = {}
+    with open(manifest_path, "r", newline="") as manifest_csv:
+        for row in csv.DictReader(manifest_csv):
+            if row["Sorted Path"]:
+                previous_files[row["Sorted Path"]] = (
+                    submission_key(row["Submission ID"], row.get("Question") or ""),
+                    row["Path"],
+                    int(row["Size"]),
+                    float(row["Mtime"]),
+                    int(row["Inode"]),
+                    row.get("Guard", ""),
+                )
+
+    previous_rows = {}
+    if os.path.isfile(processed_csv_path):
+        with open(processed_csv_path, "r", newline="") as processed_csv:
+            processed_reader = csv.reader(processed_csv)
+            header = next(processed_reader, [])
+            question_col = header.index("Question") if "Question" in header else None
+            for row in processed_reader:
+                question = row[question_col] if question_col is not None else ""
+                previous_rows[submission_key(row[0], question)] = row
+    return previous_files, previous_rows
+
+
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS assignments (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE, due_datetime TEXT, sorted_at TEXT
+);
+CREATE TABLE IF NOT EXISTS submissions (
+    assignment_id INTEGER, submission_id TEXT, question TEXT,
+    submitted_datetime TEXT, overdue_hrs REAL,
+    PRIMARY KEY (assignment_id, submission_id, question)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS submissions_id ON submissions (submission_id);
+CREATE INDEX IF NOT EXISTS submissions_overdue ON submissions (overdue_hrs);
+CREATE TABLE IF NOT EXISTS students (
+    assignment_id INTEGER, submission_id TEXT, student_id TEXT, name TEXT
+);
+CREATE INDEX IF NOT EXISTS students_student_id ON students (student_id);
+CREATE INDEX IF NOT EXISTS students_name ON students (name);
+CREATE INDEX IF NOT EXISTS students_submission ON students (assignment_id, submission_id);
+CREATE TABLE IF NOT EXISTS files (
+    assignment_id INTEGER, submission_id TEXT, question TEXT, category TEXT,
+    path TEXT, sorted_path TEXT, size INTEGER, mtime REAL, inode INTEGER,
+    content_hash TEXT
+);
+CREATE INDEX IF NOT EXISTS files_submission ON files (assignment_id, submission_id, question);
+CREATE INDEX IF NOT EXISTS files_hash ON files (content_hash);
+"""
+
+
+def store_datetime(value: datetime) -> str:
+    # in UTC, so datetimes of every assignment compare as strings
+    return value.astimezone(timezone.utc).isoformat(sep=" ")
+
+
+def hash_file(path: str, archive: zipfile.ZipFile | None = None) -> str:
+    digest = hashlib.sha256()
+    if archive is not None:
+        f = archive.open(path[len(archive.filename) + 1 :])
+    else:
+        f = open(path, "rb")
+    with f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_store(
+    store_path: str,
+    assignment: str,
+    due_datetime: datetime,
+    submissions: dict[str, Submission],
+    discovered_files: dict[tuple[str, str], DiscoveredFile],
+    sorted_paths: dict[str, str],
+    archive: zipfile.ZipFile | None = None,
+    jobs: int = 8,
+) -> None:
+    """
+    Replace the submissions, students and files of assignment in the SQLite store at
+    store_path with those just sorted, in one transaction. Files are hashed, except
+    those with the same size, mtime and inode as when they were last stored.
+    """
+    db = sqlite3.connect(store_path)
+    try:
+        db.executescript(STORE_SCHEMA)
+        previous_hashes = {
+            (path, size, mtime, inode): content_hash
+            for path, size, mtime, inode, content_hash in db.execute(
+                "SELECT path, size, mtime, inode, content_hash FROM files "
+                "JOIN assignments ON assignment_id = id WHERE name = ?",
+                (assignment,),
+            )
+        }
+
+        submission_rows = []
+        student_rows = {}
+        file_rows = []
+        stats = {}
+        for submission in submissions.values():
+            submission_rows.append(
+                (
+                    submission.id,
+                    submission.question,
+                    store_datetime(submission.submitted_datetime),
+                    submission.overdue_hrs,
+                )
+            )
+            # the questions of a submission have the same students
+            student_rows[submission.id] = [
+                (submission.id, student_id or None, name)
+                for student_id, name in zip(submission.student_ids, submission.names)
+            ]
+            for category, paths in (
+                ("code", submission.code_files),
+                ("pdf", submission.pdf_files),
+            ):
+                for path in paths:
+                    f = discovered_files[(path, category)]
+                    stats[f.path] = (f.path, f.size, f.mtime, f.inode)
+                    file_rows.append(
+                        (
+                            submission.id,
+                            submission.question,
+                            category,
+                            f.path,
+                            sorted_paths.get(f.path) if category == "code" else None,
+                            f.size,
+                            f.mtime,
+                            f.inode,
+                        )
+                    )
+
+        to_hash = [path for path, stat in stats.items() if stat not in previous_hashes]
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            hashes = dict(
+                zip(to_hash, executor.map(lambda p: hash_file(p, archive), to_hash))
+            )
+        for path, stat in stats.items():
+            if path not in hashes:
+                hashes[path] = previous_hashes[stat]
+
+        with db:
+            db.execute(
+                "INSERT INTO assignments (name, due_datetime, sorted_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET due_datetime = excluded.due_datetime, "
+                "sorted_at = excluded.sorted_at",
+                (
+                    assignment,
+                    store_datetime(due_datetime),
+                    store_datetime(datetime.now(timezone.utc)),
+                ),
+            )
+            (assignment_id,) = db.execute(
+                "SELECT id FROM assignments WHERE name = ?", (assignment,)
+            ).fetchone()
+            for table in ("submissions", "students", "files"):
+                db.execute(
+                    f"DELETE FROM {table} WHERE assignment_id = ?", (assignment_id,)
+                )
+            db.executemany(
+                "INSERT INTO submissions VALUES (?, ?, ?, ?, ?)",
+                [(assignment_id, *row) for row in submission_rows],
+            )
+            db.executemany(
+                "INSERT INTO students VALUES (?, ?, ?, ?)",
+                [
+                    (assignment_id, *row)
+                    for rows in student_rows.values()
+                    for row in rows
+                ],
+            )
+            db.executemany(
+                "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(assignment_id, *row, hashes[row[3]]) for row in file_rows],
+            )
+    finally:
+        db.close()
+    print(
+        f"Stored {len(submission_rows)} submissions and {len(file_rows)} files of {assignment} in {store_path}, hashed {len(to_hash)} files."
+    )
+
+
+def student_submissions(
+    store_path: str, student: str, since: str = "", late: bool = False
+) -> list[tuple]:
+    """
+    Return (assignment, submission id, question, submitted datetime, overdue hours)
+    for every submission in the store by the student with this id or name, submitted
+    since the (UTC) date given, or only the late ones, most recent first.
+    """
+    query = """
+        SELECT assignments.name, submissions.submission_id, question,
+            submitted_datetime, overdue_hrs
+        FROM students
+        JOIN submissions USING (assignment_id, submission_id)
+        JOIN assignments ON assignment_id = assignments.id
+        WHERE (student_id = ? OR students.name = ?) AND submitted_datetime >= ?{0}
+        ORDER BY submitted_datetime DESC
+    """.format(" AND overdue_hrs > 0" if late else "")
+    db = sqlite3.connect(store_path)
+    try:
+        return db.execute(query, (student, student, since)).fetchall()
+    finally:
+        db.close()
 
 
 def process_submissions(
@@ -46,95 +940,273 @@ def process_submissions(
     code_file_match_pattern: str,
     pdf_file_match_pattern: str,
     overdue_leniency: timedelta,
+    materialise: str = "copy",
+    jobs: int = 8,
+    manifest_path: str = "",
+    verbose: bool = False,
+    incremental: bool = False,
+    per_question: bool = False,
+    store_path: str = "",
+    assignment: str = "",
+    max_file_size: int = 0,
+    max_line_length: int = 0,
+    oversize_action: str = "skip",
 ) -> None:
-    _datetime_format = "%Y-%m-%d %H:%M:%S %z"
-
     # Convert due date string to datetime
-    due_datetime = datetime.strptime(due_date, _datetime_format)
+    due_datetime = datetime.strptime(due_date, DATETIME_FORMAT)
     tz_local = due_datetime.tzinfo
     due_datetime = due_datetime.astimezone(tz_local)
 
-    submissions: dict[str, Submission] = {}
+    archive = None
+    if os.path.isfile(assignment_files_directory):
+        # read the export zip in place, only the matched code files are extracted
+        archive = zipfile.ZipFile(assignment_files_directory)
+        metadata_name = os.path.basename(metadata_path)
+        root = export_root(archive, metadata_name)
+        metadata_path = posixpath.join(root, metadata_name)
+        discovered = discover_archive_files(
+            archive, root, code_file_match_pattern, pdf_file_match_pattern
+        )
+    else:
+        discovered = discover_submission_files(
+            assignment_files_directory,
+            code_file_match_pattern,
+            pdf_file_match_pattern,
+        )
+
+    # sniff every code file for binary content, and check it against the size and
+    # line length limits. Notebooks are checked by their code cells instead.
+    code_files = [
+        f
+        for files in discovered.values()
+        for f in files
+        if f.category == "code" and not f.path.endswith(NOTEBOOK_SUFFIX)
+    ]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        reasons = list(
+            executor.map(
+                lambda f: guard_file(f, max_file_size, max_line_length, archive),
+                code_files,
+            )
+        )
+    guarded = {
+        f.path: (
+            reason,
+            "skipped" if reason == "binary" else OVERSIZE_ACTIONS[oversize_action],
+        )
+        for f, reason in zip(code_files, reasons)
+        if reason is not None
+    }
+    truncated = {path for path, (_, action) in guarded.items() if action == "truncated"}
+    guards = {
+        path: f"truncated {max_file_size} {max_line_length}" for path in truncated
+    }
+    if guarded:
+        actions = Counter(action for _, action in guarded.values())
+        print(
+            f"{len(guarded)} code files are binary or over the limits: "
+            + ", ".join(f"{n} {action}" for action, n in actions.items())
+            + f". They are listed in {processed_csv_path}."
+        )
 
     # Read and process submission_metadata.csv
-    with open(metadata_path, "r") as metadata_csv:
-        metadata_reader = csv.DictReader(metadata_csv)
-        for row in metadata_reader:
-            if row["Status"] != "Missing":
-                submission_id = row["Submission ID"]
-                student_name = row["First Name"] + " " + row["Last Name"]
-                student_id = row["Student ID"]
+    submissions = read_submission_metadata(
+        metadata_path,
+        due_datetime,
+        overdue_leniency,
+        discovered,
+        verbose,
+        archive,
+        per_question,
+        guarded,
+    )
 
-                if submission_id in submissions:
-                    print(
-                        f"Adding {student_name} to existing submission: {submission_id}"
-                    )
-                    submissions[submission_id].names.append(student_name)
-                    submissions[submission_id].student_ids.append(student_id)
-                    continue
+    # destination -> source. Files with the same name in a submission overwrite each
+    # other as before, and no two threads write the same destination.
+    targets: dict[str, str] = {}
+    target_submissions: dict[str, str] = {}
+    for key, submission in submissions.items():
+        dirname = "-".join(["_".join(name.split(" ")) for name in submission.names])
+        if submission.question:
+            # one tree per question, for a MOSS query each
+            dirname = f"Q{submission.question}/{dirname}"
+        for codefile in submission.code_files:
+            target = f"{processed_dir_path}/{dirname}/{sorted_name(codefile)}"
+            targets[target] = codefile
+            target_submissions[target] = key
 
-                print(f"Adding new submission for student {student_name}")
-                submission_datetime: datetime = datetime.strptime(
-                    row["Question 1 Submitted At"], _datetime_format
-                ).astimezone(tz_local)
-                filepath = os.path.join(
-                    assignment_files_directory, f"submission_{submission_id}"
-                )
-                codefiles = glob.glob(os.path.join(filepath, code_file_match_pattern))
-                pdf_files = glob.glob(os.path.join(filepath, pdf_file_match_pattern))
-                overdue_hrs = 0
-                if (submission_datetime - due_datetime) > overdue_leniency:
-                    overdue_hrs = (
-                        submission_datetime - (due_datetime + overdue_leniency)
-                    ) / timedelta(hours=1)
-                submissions[submission_id] = Submission(
-                    id=submission_id,
-                    names=[student_name],
-                    student_ids=[student_id],
-                    submitted_datetime=submission_datetime,
-                    code_files=codefiles,
-                    pdf_files=pdf_files,
-                    overdue_hrs=overdue_hrs,
-                )
+    if incremental:
+        # only files that are new, or whose source moved or changed size, mtime or
+        # inode, or that are truncated differently since the previous run are
+        # written again
+        previous_files, previous_rows = read_previous_sort(
+            manifest_path, processed_csv_path
+        )
+        stats = {
+            f.path: (f.size, f.mtime, f.inode)
+            for files in discovered.values()
+            for f in files
+        }
+        to_write = {
+            target: source
+            for target, source in targets.items()
+            if previous_files.get(target, (None,))[1:]
+            != (source, *stats[source], guards.get(source, ""))
+        }
+        to_remove = [target for target in previous_files if target not in targets]
+        for target in to_remove:
+            try:
+                os.remove(target)
+            except FileNotFoundError:
+                pass
+        for directory in {os.path.dirname(target) for target in to_remove}:
+            try:
+                os.rmdir(directory)
+            except OSError:
+                # still has files of another submission
+                pass
+
+        rows = {
+            key: processed_row(submission) for key, submission in submissions.items()
+        }
+        changed = {target_submissions[target] for target in to_write} | {
+            previous_files[target][0] for target in to_remove
+        }
+        added = rows.keys() - previous_rows.keys()
+        removed = previous_rows.keys() - rows.keys()
+        updated = {
+            key
+            for key in rows.keys() & previous_rows.keys()
+            if key in changed or rows[key] != previous_rows[key]
+        }
+        print(
+            f"Incremental sort: {len(added)} new, {len(updated)} changed and {len(removed)} removed submissions, "
+            f"{len(rows) - len(added) - len(updated)} unchanged. "
+            f"Writing {len(to_write)} files and removing {len(to_remove)}."
+        )
+    else:
+        os.makedirs(processed_dir_path, exist_ok=False)
+        to_write = targets
 
     # Write submissions to a CSV
     with open(processed_csv_path, "w") as processed_csv:
         processed_writer = csv.writer(processed_csv)
         processed_writer.writerow(
-            [
-                "Submission ID",
-                "Student Names",
-                "Student IDs",
-                "Submitted Datetime",
-                "Overdue Hours",
-                "Code Files",
-                "PDF Files",
-            ]
+            PROCESSED_COLUMNS + (["Question"] if per_question else [])
         )
         for submission in submissions.values():
-            processed_writer.writerow(
+            processed_writer.writerow(processed_row(submission))
+
+    for directory in {os.path.dirname(target) for target in to_write}:
+        os.makedirs(directory, exist_ok=True)
+
+    # the files are independent, so they are materialised concurrently. Decoding
+    # notebooks is cpu bound, so they are converted in processes instead.
+    notebooks = [
+        (target, source)
+        for target, source in to_write.items()
+        if source.endswith(NOTEBOOK_SUFFIX)
+    ]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        methods = Counter(
+            executor.map(
+                lambda target: (
+                    truncate_file(
+                        target[1],
+                        target[0],
+                        max_file_size,
+                        max_line_length,
+                        incremental,
+                        archive,
+                    )
+                    if target[1] in truncated
+                    else materialise_file(
+                        target[1], target[0], materialise, incremental, archive
+                    )
+                ),
                 [
-                    submission.id,
-                    ",".join(submission.names),
-                    ",".join(submission.student_ids),
-                    submission.submitted_datetime.strftime("%Y-%m-%d %H:%M:%S %z"),
-                    submission.overdue_hrs,
-                    ",".join(submission.code_files),
-                    ",".join(submission.pdf_files),
-                ]
+                    (target, source)
+                    for target, source in to_write.items()
+                    if not source.endswith(NOTEBOOK_SUFFIX)
+                ],
             )
-
-    os.makedirs(processed_dir_path, exist_ok=False)
-    for submission in submissions.keys():
-        dirname = "-".join(
-            ["_".join(name.split(" ")) for name in submissions[submission].names]
         )
-        for codefile in submissions[submission].code_files:
-            if not os.path.exists(f"{processed_dir_path}/{dirname}"):
-                os.makedirs(f"{processed_dir_path}/{dirname}")
-            shutil.copy2(
-                codefile, f"{processed_dir_path}/{dirname}/{os.path.basename(codefile)}"
+    if notebooks:
+        with ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=open_worker_archive,
+            initargs=(archive.filename if archive is not None else None,),
+        ) as executor:
+            methods.update(
+                executor.map(
+                    materialise_notebook,
+                    [source for _, source in notebooks],
+                    [target for target, _ in notebooks],
+                    [incremental] * len(notebooks),
+                    chunksize=4,
+                )
             )
+    print(
+        f"Materialised {len(to_write)} files in {processed_dir_path}"
+        + (": " if methods else ".")
+        + ", ".join(f"{n} {method}" for method, n in methods.items())
+    )
+
+    sorted_paths = {source: target for target, source in targets.items()}
+    discovered_files = {
+        (f.path, f.category): f for files in discovered.values() for f in files
+    }
+    if store_path:
+        write_store(
+            store_path,
+            assignment,
+            due_datetime,
+            submissions,
+            discovered_files,
+            sorted_paths,
+            archive,
+            jobs,
+        )
+    if archive is not None:
+        archive.close()
+
+    if manifest_path:
+        # submit_to_moss.py reads the sorted files and their sizes from here
+        # instead of listing and statting ./sorted again
+        with open(manifest_path, "w") as manifest_csv:
+            manifest_writer = csv.writer(manifest_csv)
+            manifest_writer.writerow(MANIFEST_COLUMNS)
+            for submission in submissions.values():
+                for category, paths in (
+                    ("code", submission.code_files),
+                    ("pdf", submission.pdf_files),
+                ):
+                    for path in paths:
+                        f = discovered_files[(path, category)]
+                        manifest_writer.writerow(
+                            [
+                                submission.id,
+                                category,
+                                f.path,
+                                (
+                                    sorted_paths.get(f.path, "")
+                                    if category == "code"
+                                    else ""
+                                ),
+                                f.size,
+                                f.mtime,
+                                f.inode,
+                                submission.question,
+                                (
+                                    ""
+                                    if f.path.endswith(NOTEBOOK_SUFFIX)
+                                    or f.path in truncated
+                                    or category != "code"
+                                    else f.size
+                                ),
+                                guards.get(f.path, ""),
+                            ]
+                        )
 
 
 def main():
@@ -154,7 +1226,7 @@ def main():
         "--metadata-path",
         type=str,
         default="submission_metadata.csv",
-        help="Path to the submission metadata csv file.",
+        help="Path to the submission metadata csv file. When reading an exported .zip, the file with this name in the archive is used.",
     )
     parser.add_argument(
         "-p",
@@ -163,6 +1235,12 @@ def main():
         default="submissions_processed.csv",
         help="Path to save the processed submissions CSV.",
     )
+    parser.add_argument(
+        "--manifest-path",
+        type=str,
+        default="submissions_manifest.csv",
+        help="Path to save the list of discovered files, with their sizes and where they were sorted to. submit_to_moss.py reuses it instead of listing the sorted directory again. Empty to disable.",
+    )
     parser.add_argument(
         "-o",
         "--processed-dir-path",
@@ -175,7 +1253,7 @@ def main():
         "--assignment-files-directory",
         type=str,
         default="./",
-        help="Directory containing assignment files.",
+        help="Directory containing assignment files, or the exported .zip, which is read in place without extracting it.",
     )
 
     parser.add_argument(
@@ -190,14 +1268,86 @@ def main():
         "--code-file-match-pattern",
         type=str,
         default="*.py",
-        help="Glob pattern to match code files.",
+        help="Glob pattern to match code files, or several separated by commas, eg. '*.py,*.ipynb'. The code cells of matched notebooks are sorted as NAME.ipynb.py, without their outputs.",
     )
 
     parser.add_argument(
         "--pdf-file-match-pattern",
         type=str,
         default="*.pdf",
-        help="Glob pattern to match pdf files.",
+        help="Glob pattern to match pdf files, or several separated by commas.",
+    )
+
+    parser.add_argument(
+        "--max-file-size",
+        type=int,
+        default=1000000,
+        help="Code files larger than this many bytes are handled with --oversize-action. 0 for no limit.",
+    )
+
+    parser.add_argument(
+        "--max-line-length",
+        type=int,
+        default=1000,
+        help="Code files with a line longer than this many characters in their first 8 KB, such as minified code, are handled with --oversize-action. 0 for no limit.",
+    )
+
+    parser.add_argument(
+        "--oversize-action",
+        choices=list(OVERSIZE_ACTIONS),
+        default="skip",
+        help="What to do with code files over --max-file-size or --max-line-length: leave them out of the processed directory, truncate them to the limits, or sort them as they are. Binary files are always left out. Either way they are listed in the Oversized Files column of the processed csv.",
+    )
+
+    parser.add_argument(
+        "--materialise",
+        choices=["copy", "link"],
+        default="copy",
+        help="How code files are put in the processed directory. 'link' hardlinks them, falling back to a reflink, a symlink and then a copy, which is faster and saves space on large exports. Linked files share their contents with the originals, so do not edit them in place.",
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=8,
+        help="Number of files to copy or link at once.",
+    )
+
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        default=False,
+        action="store_true",
+        help="Print a line for every student read from the metadata, rather than a progress summary.",
+    )
+
+    parser.add_argument(
+        "--store-path",
+        type=str,
+        default="",
+        help="Also save the submissions, their students and files (with a hash of their contents) to this SQLite database, which can hold many assignments. The processed csv is still written. Empty to disable.",
+    )
+
+    parser.add_argument(
+        "--assignment-name",
+        type=str,
+        default=None,
+        help="Name of the assignment in the --store-path database. Defaults to the name of the assignment files directory or export.",
+    )
+
+    parser.add_argument(
+        "--per-question",
+        default=False,
+        action="store_true",
+        help="Sort the files of each question into their own directory (Q1, Q2, ...) of the processed directory, using the file ids in the 'Question N Response' columns, with the overdue hours of each question. submit_to_moss.py --per-question sends one query per question.",
+    )
+
+    parser.add_argument(
+        "--incremental",
+        default=False,
+        action="store_true",
+        help="Update the processed directory and csv from the previous run instead of rebuilding them, only writing the files of new or changed submissions and removing those of removed ones. Needs the manifest of the previous run.",
     )
 
     parser.add_argument(
@@ -212,7 +1362,25 @@ def main():
 
     overdue_leniency = timedelta(hours=args.overdue_leniency)
 
-    if os.path.exists(args.processed_dir_path):
+    assignment = args.assignment_name
+    if assignment is None:
+        assignment = os.path.splitext(
+            os.path.basename(os.path.abspath(args.assignment_files_directory))
+        )[0]
+
+    incremental = False
+    if args.incremental:
+        incremental = (
+            bool(args.manifest_path)
+            and os.path.isfile(args.manifest_path)
+            and os.path.isdir(args.processed_dir_path)
+        )
+        if not incremental:
+            print(
+                f"No previous run found at {args.processed_dir_path} and {args.manifest_path}, sorting all submissions."
+            )
+
+    if os.path.exists(args.processed_dir_path) and not incremental:
         if not args.force:
             print(
                 f"processed files directory {args.processed_dir_path} already exists. Please specify a different location using the --processed-dir-path, or use the --force flag to overwrite."
@@ -221,7 +1389,7 @@ def main():
         else:
             shutil.rmtree(args.processed_dir_path, ignore_errors=True)
 
-    if os.path.exists(args.processed_csv_path):
+    if os.path.exists(args.processed_csv_path) and not incremental:
         if not args.force:
             print(
                 f"processed csv file {args.processed_csv_path} already exists. Please specify using --processed-csv-path, or use the --force flag to overwrite."
@@ -239,6 +1407,17 @@ def main():
         args.code_file_match_pattern,
         args.pdf_file_match_pattern,
         overdue_leniency,
+        args.materialise,
+        args.jobs,
+        args.manifest_path,
+        args.verbose,
+        incremental,
+        args.per_question,
+        args.store_path,
+        assignment,
+        args.max_file_size,
+        args.max_line_length,
+        args.oversize_action,
     )
 
 
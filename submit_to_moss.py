@@ -12,15 +12,37 @@
 # MOSS for plagiarism detection.
 
 import os
+from stat import S_ISREG
+import asyncio
 import glob
 import socket
 from urllib.request import urlopen
-from threading import Thread
+from urllib.parse import urljoin, urlsplit
+import http.client
+import queue
+from threading import Lock, Thread
 import logging
 import re
+import csv
+import json
+import posixpath
+import hashlib
+import mmap
+import io
+import tokenize
+import zipfile
+import zlib
+import sqlite3
+import warnings
+from html import unescape
+from contextlib import contextmanager
+from collections import Counter
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import argparse
 import webbrowser
 import sys
+import time
 
 # this is the userid generated by me.
 # if it stops working, send an email to:
@@ -59,6 +81,82 @@ USERID = ""
 # SOFTWARE.
 
 
+class MossUploadError(Exception):
+    """
+    Raised by Moss.send when a session fails, recording how far it got:
+    the protocol stage, how many files and bytes were sent and in how many attempts.
+    """
+
+    def __init__(self, stage, files_sent, n_files, bytes_sent, reason, retryable=True):
+        self.stage = stage
+        self.files_sent = files_sent
+        self.n_files = n_files
+        self.bytes_sent = bytes_sent
+        self.reason = reason
+        self.retryable = retryable
+        self.attempts = 1
+        super().__init__()
+
+    def __str__(self):
+        return "send() => {} failed after {} of {} files ({} bytes), attempt {}: {}".format(
+            self.stage,
+            self.files_sent,
+            self.n_files,
+            self.bytes_sent,
+            self.attempts,
+            self.reason,
+        )
+
+
+class MossStream:
+    """
+    Framed writer/reader for the MOSS line protocol.
+
+    Header lines are buffered and flushed with a single sendall() just before
+    a file body or a read from the server. File bodies are streamed from disk with
+    socket.sendfile(), which falls back to chunked send() by itself, so nothing is
+    ever held in memory whole and short writes can't truncate an upload.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = sock.makefile("rb")
+        self.buffer = bytearray()
+        self.bytes_sent = 0
+
+    def writeLine(self, line):
+        self.buffer += line.encode() + b"\n"
+
+    def flush(self):
+        if self.buffer:
+            self.sock.sendall(self.buffer)
+            self.bytes_sent += len(self.buffer)
+            self.buffer.clear()
+
+    def sendFile(self, f, size, file_path):
+        self.flush()
+        # socket.sendfile falls back to send() by itself where os.sendfile can't be
+        # used, eg. on Windows
+        sent = self.sock.sendfile(f, 0, size)
+        if sent != size:
+            raise Exception(
+                "sendFile({}) => sent {} of {} bytes, file changed during upload?".format(
+                    file_path, sent, size
+                )
+            )
+        self.bytes_sent += sent
+
+    def readLine(self):
+        self.flush()
+        return self.reader.readline().decode().strip()
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+
 class Moss:
     languages = (
         "c",
@@ -95,6 +193,14 @@ class Moss:
         self.options = {"l": "c", "m": 10, "d": 0, "x": 0, "c": "", "n": 250}
         self.base_files = []
         self.files = []
+        # file path -> size, so each file is statted once
+        self.file_sizes = {}
+        self.upload_stats = []
+        self.connect_timeout = 30
+        self.idle_timeout = 120
+        self.query_timeout = 30 * 60
+        self.retries = 3
+        self.retry_backoff = 10
 
         if language in self.languages:
             self.options["l"] = language
@@ -115,16 +221,50 @@ class Moss:
     def setExperimentalServer(self, opt):
         self.options["x"] = opt
 
-    def addBaseFile(self, file_path, display_name=None):
-        if os.path.isfile(file_path) and os.path.getsize(file_path) > 0:
+    def setTimeouts(self, connect, idle, query):
+        # seconds to wait for the connection, for any other read or write, and for
+        # the server to answer the query once everything is uploaded
+        self.connect_timeout = connect
+        self.idle_timeout = idle
+        self.query_timeout = query
+
+    def setRetries(self, retries, backoff):
+        # failed sessions are retried from scratch, waiting backoff * 2**attempt seconds
+        self.retries = retries
+        self.retry_backoff = backoff
+
+    def fileSize(self, file_path, size=None):
+        # size may already be known, eg. from the discovery manifest
+        if size is None:
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                return 0
+            size = st.st_size if S_ISREG(st.st_mode) else 0
+        self.file_sizes[file_path] = size
+        return size
+
+    def uploadSize(self, f, file_path):
+        # sizes from the discovery manifest or a saved plan can be stale, and the size
+        # in the header must match the bytes sent, so it is taken from the open file
+        size = os.fstat(f.fileno()).st_size
+        if self.file_sizes.get(file_path, size) != size:
+            logging.warning(
+                f"{file_path} is {size} bytes, not {self.file_sizes[file_path]} as listed."
+            )
+        self.file_sizes[file_path] = size
+        return size
+
+    def addBaseFile(self, file_path, display_name=None, size=None):
+        if self.fileSize(file_path, size) > 0:
             self.base_files.append((file_path, display_name))
         else:
             raise Exception(
                 "addBaseFile({}) => File not found or is empty.".format(file_path)
             )
 
-    def addFile(self, file_path, display_name=None):
-        if os.path.isfile(file_path) and os.path.getsize(file_path) > 0:
+    def addFile(self, file_path, display_name=None, size=None):
+        if self.fileSize(file_path, size) > 0:
             self.files.append((file_path, display_name))
         else:
             raise Exception(
@@ -144,48 +284,107 @@ class Moss:
             # Display name cannot accept \, replacing it with /
             display_name = file_path.replace(" ", "_").replace("\\", "/")
 
-        size = os.path.getsize(file_path)
-        message = "file {0} {1} {2} {3}\n".format(
-            file_id, self.options["l"], size, display_name
-        )
-        s.send(message.encode())
+        start = time.perf_counter()
         with open(file_path, "rb") as f:
-            s.send(f.read(size))
+            size = self.uploadSize(f, file_path)
+            s.writeLine(
+                "file {0} {1} {2} {3}".format(
+                    file_id, self.options["l"], size, display_name
+                )
+            )
+            s.sendFile(f, size, file_path)
+        self.upload_stats.append((file_path, size, time.perf_counter() - start))
         on_send(file_path, display_name)
 
     def send(self, on_send=lambda file_path, display_name: None):
-        s = socket.socket()
-        s.connect((self.server, self.port))
-
-        s.send("moss {}\n".format(self.user_id).encode())
-        s.send("directory {}\n".format(self.options["d"]).encode())
-        s.send("X {}\n".format(self.options["x"]).encode())
-        s.send("maxmatches {}\n".format(self.options["m"]).encode())
-        s.send("show {}\n".format(self.options["n"]).encode())
-
-        s.send("language {}\n".format(self.options["l"]).encode())
-        recv = s.recv(1024)
-        if recv == "no":
-            s.send(b"end\n")
-            s.close()
-            raise Exception("send() => Language not accepted by server")
-
-        for file_path, display_name in self.base_files:
-            self.uploadFile(s, file_path, display_name, 0, on_send)
-
-        index = 1
-        for file_path, display_name in self.files:
-            self.uploadFile(s, file_path, display_name, index, on_send)
-            index += 1
-
-        s.send("query 0 {}\n".format(self.options["c"]).encode())
-
-        response = s.recv(1024)
+        attempt = 1
+        while True:
+            try:
+                return self.sendSession(on_send)
+            except MossUploadError as e:
+                e.attempts = attempt
+                if not e.retryable or attempt > self.retries:
+                    raise
+                delay = self.retry_backoff * 2 ** (attempt - 1)
+                logging.warning(f"{e}. Retrying in {delay}s.")
+                time.sleep(delay)
+                attempt += 1
+
+    def sendSession(self, on_send):
+        self.upload_stats = []
+        n_files = len(self.base_files) + len(self.files)
+        stage = "connect"
+        s = None
 
-        s.send(b"end\n")
-        s.close()
+        try:
+            s = MossStream(
+                socket.create_connection(
+                    (self.server, self.port), timeout=self.connect_timeout
+                )
+            )
+            s.sock.settimeout(self.idle_timeout)
+
+            stage = "handshake"
+            s.writeLine("moss {}".format(self.user_id))
+            s.writeLine("directory {}".format(self.options["d"]))
+            s.writeLine("X {}".format(self.options["x"]))
+            s.writeLine("maxmatches {}".format(self.options["m"]))
+            s.writeLine("show {}".format(self.options["n"]))
+
+            s.writeLine("language {}".format(self.options["l"]))
+            if s.readLine() == "no":
+                s.writeLine("end")
+                s.flush()
+                raise MossUploadError(
+                    stage,
+                    0,
+                    n_files,
+                    s.bytes_sent,
+                    "Language not accepted by server",
+                    False,
+                )
 
-        return response.decode().replace("\n", "")
+            stage = "upload"
+            for file_path, display_name in self.base_files:
+                self.uploadFile(s, file_path, display_name, 0, on_send)
+
+            index = 1
+            for file_path, display_name in self.files:
+                self.uploadFile(s, file_path, display_name, index, on_send)
+                index += 1
+
+            stage = "query"
+            s.writeLine("query 0 {}".format(self.options["c"]))
+            s.sock.settimeout(self.query_timeout)
+            response = s.readLine()
+
+            s.writeLine("end")
+            s.flush()
+        except OSError as e:
+            if e.filename is not None:
+                # a submission file could not be opened, which no retry fixes
+                raise
+            raise MossUploadError(
+                stage,
+                len(self.upload_stats),
+                n_files,
+                s.bytes_sent if s is not None else 0,
+                e,
+            ) from e
+        finally:
+            if s is not None:
+                s.close()
+
+        return response
+
+    def getUploadSummary(self):
+        """Return (total bytes, total seconds, slowest (path, size, seconds)) of the last send()."""
+        if not self.upload_stats:
+            return 0, 0.0, None
+        total_bytes = sum(size for _, size, _ in self.upload_stats)
+        total_secs = sum(secs for _, _, secs in self.upload_stats)
+        slowest = max(self.upload_stats, key=lambda stat: stat[2])
+        return total_bytes, total_secs, slowest
 
     def saveWebPage(self, url, path):
         if len(url) == 0:
@@ -200,90 +399,924 @@ class Moss:
         f.close()
 
 
-def process_url(url, urls, base_url, path, on_read):
-    from bs4 import (
-        BeautifulSoup,
-    )  # Backward compability, don't break Moss when bs4 not available.
+class AsyncMoss(Moss):
+    """
+    asyncio version of Moss. Options are set exactly as for Moss, but send() is a
+    coroutine, so many queries can be awaited together with send_queries(),
+    each over its own connection.
+    """
 
-    logging.debug("Processing URL: " + url)
-    response = urlopen(url)
-    html = response.read()
-    on_read(url)
-    soup = BeautifulSoup(html, "lxml")
+    async def uploadFile(self, writer, file_path, display_name, file_id, on_send):
+        if display_name is None:
+            display_name = file_path.replace(" ", "_").replace("\\", "/")
+
+        start = time.perf_counter()
+        sent = 0
+        with open(file_path, "rb") as f:
+            size = self.uploadSize(f, file_path)
+            writer.write(
+                "file {0} {1} {2} {3}\n".format(
+                    file_id, self.options["l"], size, display_name
+                ).encode()
+            )
+            while sent < size:
+                # file reads happen off the event loop so other queries keep moving
+                chunk = await asyncio.to_thread(
+                    f.read, min(MossStream.chunk_size, size - sent)
+                )
+                if not chunk:
+                    break
+                writer.write(chunk)
+                await asyncio.wait_for(writer.drain(), self.idle_timeout)
+                sent += len(chunk)
+        if sent != size:
+            raise Exception(
+                "uploadFile({}) => sent {} of {} bytes, file changed during upload?".format(
+                    file_path, sent, size
+                )
+            )
+        self.upload_stats.append((file_path, size, time.perf_counter() - start))
+        on_send(file_path, display_name)
+
+    async def send(self, on_send=lambda file_path, display_name: None, semaphore=None):
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(1)
+
+        attempt = 1
+        while True:
+            try:
+                async with semaphore:
+                    return await self.sendSession(on_send)
+            except MossUploadError as e:
+                e.attempts = attempt
+                if not e.retryable or attempt > self.retries:
+                    raise
+                delay = self.retry_backoff * 2 ** (attempt - 1)
+                logging.warning(f"{e}. Retrying in {delay}s.")
+                # the connection slot is released while waiting to retry
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def sendSession(self, on_send):
+        self.upload_stats = []
+        n_files = len(self.base_files) + len(self.files)
+        stage = "connect"
+        writer = None
+
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.server, self.port), self.connect_timeout
+            )
+
+            stage = "handshake"
+            writer.write(
+                (
+                    "moss {}\n".format(self.user_id)
+                    + "directory {}\n".format(self.options["d"])
+                    + "X {}\n".format(self.options["x"])
+                    + "maxmatches {}\n".format(self.options["m"])
+                    + "show {}\n".format(self.options["n"])
+                    + "language {}\n".format(self.options["l"])
+                ).encode()
+            )
+            await asyncio.wait_for(writer.drain(), self.idle_timeout)
+            answer = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+            if answer.decode().strip() == "no":
+                writer.write(b"end\n")
+                await writer.drain()
+                raise MossUploadError(
+                    stage, 0, n_files, 0, "Language not accepted by server", False
+                )
+
+            stage = "upload"
+            for file_path, display_name in self.base_files:
+                await self.uploadFile(writer, file_path, display_name, 0, on_send)
+
+            index = 1
+            for file_path, display_name in self.files:
+                await self.uploadFile(writer, file_path, display_name, index, on_send)
+                index += 1
+
+            stage = "query"
+            writer.write("query 0 {}\n".format(self.options["c"]).encode())
+            await asyncio.wait_for(writer.drain(), self.idle_timeout)
+            response = await asyncio.wait_for(reader.readline(), self.query_timeout)
+            response = response.decode().strip()
+
+            writer.write(b"end\n")
+            await asyncio.wait_for(writer.drain(), self.idle_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            if getattr(e, "filename", None) is not None:
+                # a submission file could not be opened, which no retry fixes
+                raise
+            raise MossUploadError(
+                stage,
+                len(self.upload_stats),
+                n_files,
+                sum(size for _, size, _ in self.upload_stats),
+                e if str(e) else "timed out",
+            ) from e
+        finally:
+            if writer is not None:
+                writer.close()
+
+        return response
+
+
+async def send_queries(
+    queries, max_connections=4, on_send=lambda file_path, display_name: None
+):
+    """
+    Send every AsyncMoss query in `queries` concurrently, with at most
+    `max_connections` open at once. Returns the report urls in the same order,
+    or the exception raised for a query that failed.
+    """
+    semaphore = asyncio.Semaphore(max_connections)
+    return await asyncio.gather(
+        *(query.send(on_send, semaphore) for query in queries),
+        return_exceptions=True,
+    )
+
+
+class KeepAliveFetcher:
+    """
+    Fetches pages over persistent HTTP/1.1 connections, one per host. Not thread
+    safe: each download worker has its own, so a report costs one TCP handshake
+    per worker instead of one per page.
+    """
+
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self.connections = {}
+        self.connects = 0
+
+    def connection(self, scheme, netloc):
+        key = (scheme, netloc)
+        if key not in self.connections:
+            if scheme == "https":
+                self.connections[key] = http.client.HTTPSConnection(
+                    netloc, timeout=self.timeout
+                )
+            else:
+                self.connections[key] = http.client.HTTPConnection(
+                    netloc, timeout=self.timeout
+                )
+            self.connects += 1
+        return self.connections[key]
+
+    def stream(self, url, redirects=5, chunk_size=64 * 1024):
+        """Yield the body of url in chunks, reading the response to the end so the connection can be reused."""
+        parts = urlsplit(url)
+        target = parts.path or "/"
+        if parts.query:
+            target += "?" + parts.query
+
+        for attempt in range(2):
+            conn = self.connection(parts.scheme, parts.netloc)
+            try:
+                conn.request("GET", target, headers={"Connection": "keep-alive"})
+                response = conn.getresponse()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # the server may close an idle keep-alive connection, so reconnect once
+                conn.close()
+                del self.connections[(parts.scheme, parts.netloc)]
+                if attempt > 0:
+                    raise
+
+        if response.status in (301, 302, 303, 307, 308) and redirects > 0:
+            response.read()
+            yield from self.stream(
+                urljoin(url, response.getheader("Location")), redirects - 1, chunk_size
+            )
+            return
+        if response.status != 200:
+            response.read()
+            raise Exception("fetch({}) => HTTP {}".format(url, response.status))
+        while True:
+            chunk = response.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        for conn in self.connections.values():
+            conn.close()
+        self.connections.clear()
+
+
+def resolve_link(link, base_url):
+    """
+    Return (url to download, local link) for a link to a results page,
+    or None for any other link.
+    """
+    if not link or link.find("match") == -1:  # Download only results urls
+        return None
+
+    link_fragments = link.split("#")
+    link = link_fragments[0]  # remove fragment from url
+
+    link_hash = ""
+    if len(link_fragments) > 1:
+        link_hash = "#" + link_fragments[1]
+
+    basename = os.path.basename(link)
+
+    if basename == link:  # Handling relative urls
+        link = base_url + basename
+
+    return link, basename + link_hash
+
+
+def page_file_name(url):
     file_name = os.path.basename(url)
 
     if (
         not file_name or len(file_name.split(".")) == 1
     ):  # Not file name eg. 123456789 or is None
         file_name = "index.html"
+    return file_name
+
+
+LINK_TAG = re.compile(rb"<(a|frame)\b[^>]*>", re.IGNORECASE)
+LINK_ATTRIBUTE = re.compile(
+    rb"""(\s)(href|src)(\s*=\s*)("[^"]*"|'[^']*'|[^\s"'>]+)""", re.IGNORECASE
+)
+
+
+def rewrite_links(chunks, base_url, out, links, keep_link=lambda link: True):
+    """
+    Copy html from the byte chunks to the file out, rewriting the href of <a> and the
+    src of <frame> tags that point to results pages to the local file name.
+    Everything else is copied byte for byte. Urls to download are appended to links.
+    Results links for which keep_link is false are made absolute instead, so they
+    point at the MOSS server. Returns (bytes written, sha256 hexdigest).
+    """
+    digest = hashlib.sha256()
+    size = 0
+
+    def rewrite_tag(tag_match):
+        tag = tag_match.group(1).lower()
+        wanted = b"href" if tag == b"a" else b"src"
+
+        def rewrite_attribute(attr_match):
+            if attr_match.group(2).lower() != wanted:
+                return attr_match.group(0)
+            value = attr_match.group(4)
+            quote = value[:1] if value[:1] in (b'"', b"'") else b""
+            link = value.strip(b"\"'").decode("latin-1")
+            resolved = resolve_link(link, base_url)
+            if resolved is None:
+                return attr_match.group(0)
+            if keep_link(resolved[0]):
+                links.append(resolved[0])
+                # frames never keep the fragment, as in the BeautifulSoup rewriter
+                local = resolved[1] if tag == b"a" else resolved[1].split("#")[0]
+            else:
+                local = resolved[0] + link[len(link.split("#")[0]) :]
+            return (
+                attr_match.group(1)
+                + attr_match.group(2)
+                + attr_match.group(3)
+                + quote
+                + local.encode("latin-1")
+                + quote
+            )
 
-    for more_url in soup.find_all(["a", "frame"]):
-        if more_url.has_attr("href"):
-            link = more_url.get("href")
-        else:
-            link = more_url.get("src")
+        return LINK_ATTRIBUTE.sub(rewrite_attribute, tag_match.group(0))
+
+    pending = b""
+    for chunk in chunks:
+        pending += chunk
+        # hold back a tag that may continue in the next chunk
+        cut = pending.rfind(b"<")
+        if cut == -1 or pending.find(b">", cut) != -1:
+            cut = len(pending)
+        data = LINK_TAG.sub(rewrite_tag, pending[:cut])
+        pending = pending[cut:]
+        out.write(data)
+        digest.update(data)
+        size += len(data)
+
+    data = LINK_TAG.sub(rewrite_tag, pending)
+    out.write(data)
+    digest.update(data)
+    size += len(data)
+    return size, digest.hexdigest()
+
+
+def process_url(
+    url, html, base_url, path, rewriter="fast", keep_link=lambda link: True
+):
+    """
+    Save the page at url, whose body is html (bytes or an iterable of byte chunks),
+    into path (a directory, or a ReportDirectory/ReportArchive) with its results links made local (or absolute, if keep_link is false
+    for them). The "fast" rewriter streams the page to disk, the "soup" rewriter
+    re-serialises it through BeautifulSoup and lxml. Returns the page's manifest entry.
+    """
+    logging.debug("Processing URL: " + url)
+    file_name = page_file_name(url)
+    links = []
+
+    if isinstance(path, str):
+        path = ReportDirectory(path)
+
+    if rewriter == "fast":
+        if isinstance(html, bytes):
+            html = [html]
+        with path.open(file_name) as f:
+            size, sha256 = rewrite_links(html, base_url, f, links, keep_link)
+    else:
+        from bs4 import (
+            BeautifulSoup,
+        )  # Backward compability, don't break Moss when bs4 not available.
+
+        if not isinstance(html, bytes):
+            html = b"".join(html)
+        soup = BeautifulSoup(html, "lxml")
+
+        for more_url in soup.find_all(["a", "frame"]):
+            if more_url.has_attr("href"):
+                link = more_url.get("href")
+            else:
+                link = more_url.get("src")
 
-        if link and (link.find("match") != -1):  # Download only results urls
-            link_fragments = link.split("#")
-            link = link_fragments[0]  # remove fragment from url
+            resolved = resolve_link(link, base_url)
+            if resolved is None:
+                continue
+            link, local = resolved
+            if not keep_link(link):
+                local = link + local[len(local.split("#")[0]) :]
 
-            link_hash = ""
-            if len(link_fragments) > 1:
-                link_hash = "#" + link_fragments[1]
+            if more_url.name == "a":
+                more_url["href"] = local
+            elif more_url.name == "frame":
+                more_url["src"] = local.split("#")[0]
+
+            if keep_link(link):
+                links.append(link)
+
+        content = soup.encode(soup.original_encoding)
+        with path.open(file_name) as f:
+            f.write(content)
+        size, sha256 = len(content), hashlib.sha256(content).hexdigest()
+
+    return {
+        "url": url,
+        "file": file_name,
+        "size": size,
+        "sha256": sha256,
+        "links": links,
+    }
+
+
+INDEX_ROW = re.compile(
+    rb"<TR>\s*<TD>\s*<A HREF=\"([^\"]*)\"[^>]*>([^<]*)\((\d+)%\)\s*</A>"
+    rb".*?<A HREF=\"([^\"]*)\"[^>]*>([^<]*)\((\d+)%\)\s*</A>"
+    rb".*?<TD[^>]*>\s*(\d+)",
+    re.IGNORECASE | re.DOTALL,
+)
+
+
+def select_matches(index_html, base_url, min_similarity=None, min_lines=None, top=None):
+    """
+    Return the urls of the match pages in a report index whose pair has a similarity
+    above min_similarity on either side and more than min_lines lines matched, as in
+    moss_nodes.py, keeping only the top pairs by similarity if top is set.
+    """
+    rows = []
+    for match in INDEX_ROW.finditer(index_html):
+        href1, _, pct1, href2, _, pct2, lines = match.groups()
+        pct = max(int(pct1), int(pct2))
+        if min_similarity is not None and pct <= min_similarity:
+            continue
+        if min_lines is not None and int(lines) <= min_lines:
+            continue
+        links = {
+            resolve_link(href.decode("latin-1"), base_url)[0] for href in (href1, href2)
+        }
+        rows.append((pct, int(lines), links))
+    if top:
+        rows = sorted(rows, key=lambda row: row[:2], reverse=True)[:top]
+    return set().union(*(links for _, _, links in rows))
+
+
+MATCH_PAGE = re.compile(r"match(\d+)\.html$")
+MATCH_TOP_PAGE = re.compile(r"match(\d+)-top\.html$")
+# a row of the table on matchN-top.html links the same region in both files
+TOP_ROW = re.compile(
+    rb"<A HREF=\"[^\"]*-0\.html#(\d+)\"[^>]*>\s*(\d+)-(\d+)\s*</A>"
+    rb".*?<A HREF=\"[^\"]*-1\.html#\1\"[^>]*>\s*(\d+)-(\d+)\s*</A>",
+    re.IGNORECASE | re.DOTALL,
+)
+
+
+def index_pairs(index_html):
+    """
+    Return (match number, file1, student1, similarity1, file2, student2, similarity2,
+    lines matched) for every row of a report index.
+    """
+    pairs = []
+    for row in INDEX_ROW.finditer(index_html):
+        href1, name1, pct1, _, name2, pct2, lines = row.groups()
+        page = MATCH_PAGE.search(urlsplit(href1.decode("latin-1")).path)
+        if page is None:
+            continue
+        name1 = unescape(name1.decode("utf-8", "replace")).strip()
+        name2 = unescape(name2.decode("utf-8", "replace")).strip()
+        pairs.append(
+            (
+                int(page.group(1)),
+                name1,
+                student_of(name1),
+                int(pct1),
+                name2,
+                student_of(name2),
+                int(pct2),
+                int(lines),
+            )
+        )
+    return pairs
+
+
+def top_ranges(top_html):
+    """Return (region, start1, end1, start2, end2) for every region on a matchN-top.html page."""
+    return [tuple(int(n) for n in row.groups()) for row in TOP_ROW.finditer(top_html)]
+
+
+MATCH_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pairs (
+    id INTEGER PRIMARY KEY,
+    file1 TEXT, student1 TEXT, similarity1 INTEGER,
+    file2 TEXT, student2 TEXT, similarity2 INTEGER,
+    lines_matched INTEGER
+);
+CREATE INDEX IF NOT EXISTS pairs_student1 ON pairs (student1, similarity1);
+CREATE INDEX IF NOT EXISTS pairs_student2 ON pairs (student2, similarity2);
+CREATE INDEX IF NOT EXISTS pairs_similarity ON pairs (max(similarity1, similarity2));
+CREATE TABLE IF NOT EXISTS ranges (
+    pair_id INTEGER, region INTEGER,
+    start1 INTEGER, end1 INTEGER, start2 INTEGER, end2 INTEGER,
+    PRIMARY KEY (pair_id, region)
+) WITHOUT ROWID;
+"""
+
+
+class MatchStore:
+    """
+    The pairs in a report and the line ranges matched between them, extracted from the
+    pages as they are downloaded into an SQLite database, so they can be queried
+    without parsing the html again. Pair ids are the N of matchN.html. Ranges are
+    only there for pairs whose match pages were downloaded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(MATCH_STORE_SCHEMA)
+
+    def addPairs(self, pairs):
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO pairs VALUES (?, ?, ?, ?, ?, ?, ?, ?)", pairs
+            )
 
-            basename = os.path.basename(link)
+    def addRanges(self, pair_id, ranges):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM ranges WHERE pair_id = ?", (pair_id,))
+            self.db.executemany(
+                "INSERT INTO ranges VALUES (?, ?, ?, ?, ?, ?)",
+                [(pair_id, *r) for r in ranges],
+            )
 
-            if basename == link:  # Handling relative urls
-                link = base_url + basename
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def match_regions(store_path, student, other=None):
+    """
+    Return (other student, similarity, start, end, other start, other end) for every
+    region of student's submission that matched another one, or only other's, from
+    the match store of a report, most similar first.
+    """
+    query = """
+        SELECT student2, similarity1, start1, end1, start2, end2
+        FROM pairs JOIN ranges ON pair_id = id WHERE student1 = ?{0}
+        UNION ALL
+        SELECT student1, similarity2, start2, end2, start1, end1
+        FROM pairs JOIN ranges ON pair_id = id WHERE student2 = ?{1}
+        ORDER BY 2 DESC, 1, 3
+    """
+    if other is None:
+        query, params = query.format("", ""), (student, student)
+    else:
+        query = query.format(" AND student2 = ?", " AND student1 = ?")
+        params = (student, other, student, other)
+    db = sqlite3.connect(store_path)
+    try:
+        return db.execute(query, params).fetchall()
+    finally:
+        db.close()
 
-            if more_url.name == "a":
-                more_url["href"] = basename + link_hash
-            elif more_url.name == "frame":
-                more_url["src"] = basename
 
-            if link not in urls:
-                urls.append(link)
+# every fetched page is appended to this file in the report directory,
+# so an interrupted download can be resumed
+MANIFEST_NAME = "manifest.jsonl"
+MATCH_STORE_NAME = "matches.sqlite"
 
-    f = open(os.path.join(path, file_name), "wb")
-    f.write(soup.encode(soup.original_encoding))
-    f.close()
+
+def load_manifest(lines):
+    """Return (report url, {page url: entry}, complete) from the lines of a manifest."""
+    report_url = None
+    pages = {}
+    complete = False
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            # a line cut short by an interrupted download
+            continue
+        if "report" in entry:
+            report_url = entry["report"]
+        elif "complete" in entry:
+            complete = entry["complete"]
+        else:
+            pages[entry["url"]] = entry
+    return report_url, pages, complete
+
+
+class ReportDirectory:
+    """A downloaded report stored as one file per page in a directory."""
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest_path = os.path.join(path, MANIFEST_NAME)
+        self.matches_path = os.path.join(path, MATCH_STORE_NAME)
+        self.index_path = f"{path}/index.html"
+
+    def manifestLines(self):
+        if not os.path.isfile(self.manifest_path):
+            return []
+        with open(self.manifest_path, "r") as f:
+            return f.readlines()
+
+    @contextmanager
+    def open(self, name):
+        # the page is streamed while it is fetched, so write it under a temporary
+        # name and only replace the page once the whole body has arrived
+        file_path = os.path.join(self.path, name)
+        try:
+            with open(file_path + ".part", "wb") as f:
+                yield f
+        except BaseException:
+            os.remove(file_path + ".part")
+            raise
+        os.replace(file_path + ".part", file_path)
+
+    def hasPage(self, entry):
+        file_path = os.path.join(self.path, entry["file"])
+        if not os.path.isfile(file_path) or os.path.getsize(file_path) != entry["size"]:
+            return False
+        return hash_file(file_path)[0] == entry["sha256"]
+
+    @contextmanager
+    def snapshot(self):
+        yield
+
+    def close(self, complete_note=None):
+        if complete_note is not None:
+            with open(os.path.join(self.path, "DOWNLOAD_COMPLETE"), "w") as f:
+                f.write(complete_note)
+
+
+class ReportArchive:
+    """
+    A downloaded report stored as a single zip file, whose central directory gives
+    random access to every page. Pages from all download workers are written through
+    a lock, and held in memory while a snapshot of the archive is being read. The
+    manifest is kept beside the archive while downloading, and moved into it once the
+    download is complete. The match store stays beside the archive.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest_path = path + "." + MANIFEST_NAME
+        self.matches_path = os.path.splitext(path)[0] + "." + MATCH_STORE_NAME
+        self.index_path = path
+        self.lock = Lock()
+        self.readers = 0
+        self.pending = []
+        # whether a member was written again with other contents
+        self.stale = False
+        self.zip = zipfile.ZipFile(path, "a", zipfile.ZIP_DEFLATED)
+
+    def manifestLines(self):
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path, "r") as f:
+                return f.readlines()
+        if MANIFEST_NAME in self.zip.namelist():
+            return self.zip.read(MANIFEST_NAME).decode().splitlines()
+        return []
+
+    def writestr(self, name, data):
+        if self.readers:
+            # appending would overwrite the central directory the readers rely on
+            self.pending.append((name, data))
+            return
+        try:
+            info = self.zip.getinfo(name)
+            if info.file_size == len(data) and info.CRC == zlib.crc32(data):
+                # eg. the index, fetched again when resuming
+                return
+            self.stale = True
+        except KeyError:
+            pass
+        # pages that changed are appended under the same name, reading the archive
+        # returns the newest copy, and the old copies are dropped on close
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            self.zip.writestr(name, data)
+
+    @contextmanager
+    def open(self, name):
+        buffer = io.BytesIO()
+        yield buffer
+        with self.lock:
+            self.writestr(name, buffer.getvalue())
+
+    def hasPage(self, entry):
+        with self.lock:
+            try:
+                info = self.zip.getinfo(entry["file"])
+            except KeyError:
+                return False
+            if info.file_size != entry["size"]:
+                return False
+            return hashlib.sha256(self.zip.read(info)).hexdigest() == entry["sha256"]
+
+    @contextmanager
+    def snapshot(self):
+        # write the central directory so far, so the archive can be read while
+        # the download carries on
+        with self.lock:
+            self.zip.close()
+            self.zip = zipfile.ZipFile(self.path, "a", zipfile.ZIP_DEFLATED)
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.readers -= 1
+                if not self.readers:
+                    pending, self.pending = self.pending, []
+                    for name, data in pending:
+                        self.writestr(name, data)
+
+    def close(self, complete_note=None):
+        with self.lock:
+            if complete_note is not None:
+                self.writestr("DOWNLOAD_COMPLETE", complete_note)
+                with open(self.manifest_path, "rb") as f:
+                    self.writestr(MANIFEST_NAME, f.read())
+            self.zip.close()
+            if self.stale:
+                self.compact()
+        if complete_note is not None:
+            os.remove(self.manifest_path)
+
+    def compact(self):
+        # rewrite the archive with only the newest copy of each member
+        with zipfile.ZipFile(self.path) as old, zipfile.ZipFile(
+            self.path + ".tmp", "w", zipfile.ZIP_DEFLATED
+        ) as new:
+            newest = {info.filename: info for info in old.infolist()}
+            for info in newest.values():
+                new.writestr(info, old.read(info))
+        os.replace(self.path + ".tmp", self.path)
+        self.stale = False
+
+
+def find_report_storage(path, url, archive=False):
+    # same candidates as make_dir, so a rerun finds the report it created before
+    for candidate in [path] + [f"{path}.{i}" for i in range(1, 12)]:
+        if archive:
+            candidate += ".zip"
+            if not os.path.isfile(candidate):
+                continue
+            try:
+                storage = ReportArchive(candidate)
+            except zipfile.BadZipFile:
+                # the previous download was killed before the archive was closed
+                print(f"WARNING: {candidate} is not a valid archive, skipping it.")
+                continue
+        else:
+            storage = ReportDirectory(candidate)
+        if load_manifest(storage.manifestLines())[0] == url:
+            return storage
+        if archive:
+            storage.close()
+    return None
+
+
+def make_archive(path):
+    for candidate in [path] + [f"{path}.{i}" for i in range(1, 12)]:
+        if not os.path.exists(candidate + ".zip"):
+            return candidate + ".zip"
+    print(f"Failed to create archive {path}.zip. Too many attempts.")
+    sys.exit(1)
+
+
+def write_extra_files(storage, extra_files):
+    for name, content in (extra_files or {}).items():
+        with storage.open(name) as f:
+            f.write(content)
 
 
 def download_report(
-    url, path, connections=4, log_level=logging.DEBUG, on_read=lambda url: None
+    url,
+    path,
+    connections=4,
+    log_level=logging.DEBUG,
+    on_read=lambda url: None,
+    index_only=False,
+    rewriter="fast",
+    min_similarity=None,
+    min_lines=None,
+    top=None,
+    on_index=lambda index_path: None,
+    archive=False,
+    extra_files=None,
 ):
+    """
+    Download the report at url into the directory path (or path.N if it exists),
+    or into the single zip file path.zip if archive is set. Returns the path of
+    index.html, or of the archive.
+    """
     logging.basicConfig(level=log_level)
 
     if len(url) == 0:
         raise Exception("Empty url supplied")
 
-    output_dir = make_dir(path)
-    print(f"The MOSS report will now be downloaded into {output_dir}")
+    # the complete marker records the selection, so changing it downloads the difference
+    selection = [min_similarity, min_lines, top]
+    selective = selection != [None, None, None]
+
+    storage = find_report_storage(path, url, archive)
+    if storage is None:
+        if archive:
+            storage = ReportArchive(make_archive(path))
+        else:
+            storage = ReportDirectory(make_dir(path))
+        print(f"The MOSS report will now be downloaded into {storage.path}")
+        pages = {}
+        if os.path.exists(storage.matches_path):
+            # left over from an archive that has since been deleted
+            os.remove(storage.matches_path)
+        with open(storage.manifest_path, "w") as f:
+            f.write(json.dumps({"report": url}) + "\n")
+    else:
+        _, pages, complete = load_manifest(storage.manifestLines())
+        if (
+            complete == selection
+            and not index_only
+            and all(storage.hasPage(entry) for entry in pages.values())
+        ):
+            write_extra_files(storage, extra_files)
+            storage.close()
+            print(f"The MOSS report has already been downloaded into {storage.path}")
+            on_index(storage.index_path)
+            return storage.index_path
+        if complete is not False and archive:
+            # reopen the manifest that was moved into the archive
+            with open(storage.manifest_path, "w") as f:
+                f.writelines(
+                    line.rstrip("\n") + "\n" for line in storage.manifestLines()
+                )
+        print(f"Resuming the download of the MOSS report into {storage.path}")
+
+    write_extra_files(storage, extra_files)
 
     base_url = url + "/"
-    urls = [url]
-    threads = []
+    manifest = open(storage.manifest_path, "a")
+    matches = MatchStore(storage.matches_path)
+    manifest_lock = Lock()
 
     logging.debug("=" * 80)
     logging.debug("Downloading Moss Report - URL: " + url)
     logging.debug("=" * 80)
 
-    # Handling thread
-    for url in urls:
-        t = Thread(target=process_url, args=[url, urls, base_url, output_dir, on_read])
-        t.start()
-        threads.append(t)
-
-        if len(threads) == connections or len(urls) < connections:
-            for thread in threads:
-                thread.join()
-                threads.remove(thread)
+    # every url is queued at most once: the set records what has been queued,
+    # the queue holds what is left to download.
+    frontier = queue.Queue()
+    seen = {url}
+    seen_lock = Lock()
+    frontier.put(url)
+    failed = []
+    skipped = []
+    connects = []
+
+    def worker():
+        fetcher = KeepAliveFetcher()
+        while True:
+            page_url = frontier.get()
+            if page_url is None:
+                frontier.task_done()
                 break
-
-    logging.debug("Waiting for all threads to complete")
+            try:
+                entry = pages.get(page_url)
+                if page_url != url and entry is not None and storage.hasPage(entry):
+                    skipped.append(page_url)
+                else:
+                    html = fetcher.stream(page_url)
+                    top_page = MATCH_TOP_PAGE.search(page_file_name(page_url))
+                    if page_url == url or top_page:
+                        # the index and the top frames are small, so they are read whole
+                        # and the pairs and matched ranges in them go to the match store
+                        html = b"".join(html)
+                        if top_page:
+                            matches.addRanges(int(top_page.group(1)), top_ranges(html))
+                        else:
+                            matches.addPairs(index_pairs(html))
+                    selected = None
+                    if page_url == url and selective:
+                        # only the match pages of the selected pairs are downloaded,
+                        # the other rows keep linking to the MOSS server
+                        selected = select_matches(
+                            html, base_url, min_similarity, min_lines, top
+                        )
+                    entry = process_url(
+                        page_url,
+                        html,
+                        base_url,
+                        storage,
+                        rewriter,
+                        (
+                            (lambda link: True)
+                            if selected is None
+                            else selected.__contains__
+                        ),
+                    )
+                    on_read(page_url)
+                    with manifest_lock:
+                        manifest.write(json.dumps(entry) + "\n")
+                        manifest.flush()
+
+                # in index_only mode the pages linked from the index are left as they are
+                if not index_only:
+                    for link in entry["links"]:
+                        with seen_lock:
+                            if link in seen:
+                                continue
+                            seen.add(link)
+                        frontier.put(link)
+
+                if page_url == url:
+                    # the links of the index are queued first, so the other workers
+                    # download the rest of the report while on_index runs
+                    try:
+                        with storage.snapshot():
+                            on_index(storage.index_path)
+                    except Exception as e:
+                        logging.error(f"Processing {entry['file']} failed: {e}")
+            except Exception as e:
+                logging.error(f"Failed to download {page_url}: {e}")
+                failed.append(page_url)
+            finally:
+                frontier.task_done()
+        connects.append(fetcher.connects)
+        fetcher.close()
+
+    threads = [Thread(target=worker, daemon=True) for _ in range(connections)]
     for thread in threads:
-        thread.join()
-    return f"{output_dir}/index.html"
+        thread.start()
+
+    try:
+        frontier.join()
+        logging.debug("Waiting for all threads to complete")
+        for _ in threads:
+            frontier.put(None)
+        for thread in threads:
+            thread.join()
+    finally:
+        complete_note = None
+        if not failed and not index_only:
+            manifest.write(json.dumps({"complete": selection}) + "\n")
+            complete_note = f"{len(seen)} pages\n"
+        manifest.close()
+        matches.close()
+        # an archive is only readable once closed, so it is closed even if interrupted
+        storage.close(complete_note)
+
+    print(
+        f"Downloaded {len(seen) - len(failed) - len(skipped)} pages over {sum(connects)} connections, {len(skipped)} already on disk."
+    )
+    if failed:
+        print(
+            f"WARNING: {len(failed)} pages could not be downloaded. Run again to resume the download."
+        )
+    return storage.index_path
 
 
 # end moss.py, the rest is my code
@@ -316,6 +1349,653 @@ def make_dir(output_dir_name):
     return output_dir
 
 
+# files at least this big are hashed through mmap rather than read into memory
+MMAP_THRESHOLD = 1024 * 1024
+
+
+def student_of(file_path):
+    # submissions are sorted into one directory per student
+    return os.path.basename(os.path.dirname(file_path))
+
+
+def group_by_student(files, key=lambda file: file):
+    submissions = {}
+    for file in files:
+        submissions.setdefault(student_of(key(file)), []).append(file)
+    return submissions
+
+
+def hash_file(file_path, normalise_whitespace=False):
+    """Return (sha256 hexdigest, line count) for file_path."""
+    digest = hashlib.sha256()
+    lines = 0
+    with open(file_path, "rb") as f:
+        if normalise_whitespace:
+            # hash each non-blank line with its whitespace collapsed, so files that
+            # differ only in indentation, trailing spaces or blank lines collide.
+            for line in f:
+                words = line.split()
+                if words:
+                    digest.update(b" ".join(words) + b"\n")
+                    lines += 1
+        elif os.fstat(f.fileno()).st_size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                digest.update(mm)
+                lines = sum(
+                    mm[i : i + MMAP_THRESHOLD].count(b"\n")
+                    for i in range(0, len(mm), MMAP_THRESHOLD)
+                )
+        else:
+            data = f.read()
+            digest.update(data)
+            lines = data.count(b"\n")
+    return digest.hexdigest(), lines
+
+
+def dedupe_submissions(moss, normalise_whitespace=False):
+    """
+    Drop submissions from moss.files whose content is identical to one already
+    queued, so each unique submission is uploaded once. A submission is the set
+    of files in one student directory (a single file when dir_mode is off), so a
+    student is only dropped when everything they submitted is a copy.
+
+    Returns a list of (representative, duplicate, lines) for every dropped submission.
+    """
+    submissions = group_by_student(moss.files, key=lambda file: file[0])
+
+    representatives = {}
+    duplicates = []
+    kept = []
+    for student, files in submissions.items():
+        hashes = [hash_file(file_path, normalise_whitespace) for file_path, _ in files]
+        key = tuple(sorted(digest for digest, _ in hashes))
+        if key in representatives:
+            duplicates.append(
+                (representatives[key], student, sum(lines for _, lines in hashes))
+            )
+            continue
+        representatives[key] = student
+        kept.extend(files)
+
+    moss.files = kept
+    return duplicates
+
+
+def duplicates_csv(duplicates):
+    duplicates_csv = io.StringIO()
+    writer = csv.writer(duplicates_csv)
+    writer.writerow(["Representative", "Duplicate", "Lines"])
+    writer.writerows(duplicates)
+    return duplicates_csv.getvalue().encode()
+
+
+def normalise_line(line):
+    return " ".join(line.split())
+
+
+def read_submission_lines(file_paths):
+    lines = []
+    for file_path in file_paths:
+        with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+            lines.extend(line.rstrip("\n") for line in f)
+    return lines
+
+
+def infer_base_file(file_paths, min_fraction, output_path, min_lines=3):
+    """
+    Write a base file made of the passages shared by more than min_fraction of the
+    submissions, e.g. skeleton code handed out to every student.
+
+    Lines are compared with their whitespace collapsed and counted once per
+    submission (student directory). Identical submissions are counted once, so
+    copies of one student's code can not pass for skeleton code. A passage is a
+    run of at least min_lines consecutive common lines, copied verbatim so MOSS
+    fingerprints it the same way as the submissions. Returns the number of
+    passages written.
+    """
+    submissions = group_by_student(file_paths)
+
+    with ProcessPoolExecutor() as executor:
+        all_lines = list(
+            executor.map(read_submission_lines, submissions.values(), chunksize=16)
+        )
+    # infer_base_file runs before dedupe_submissions, so duplicates are still here
+    distinct = {}
+    for lines in all_lines:
+        digest = hashlib.sha256("\n".join(sorted(lines)).encode()).digest()
+        distinct.setdefault(digest, lines)
+    all_lines = list(distinct.values())
+
+    counts = Counter()
+    for lines in all_lines:
+        counts.update({normalise_line(line) for line in lines})
+    counts.pop("", None)
+    threshold = min_fraction * len(all_lines)
+
+    passages = {}
+    for lines in all_lines:
+        run = []
+        # None is a sentinel that closes the last run
+        for line in lines + [None]:
+            norm = normalise_line(line) if line is not None else None
+            if norm == "":
+                # blank lines neither extend nor break a passage
+                continue
+            if norm is not None and counts[norm] > threshold:
+                run.append(line)
+                continue
+            if len(run) >= min_lines:
+                passages.setdefault(tuple(normalise_line(l) for l in run), run)
+            run = []
+
+    if passages:
+        with open(output_path, "w", encoding="utf-8") as f:
+            f.write("\n\n".join("\n".join(run) for run in passages.values()) + "\n")
+    return len(passages)
+
+
+def submission_hashes(file_paths):
+    return {
+        student: sorted(hash_file(file_path)[0] for file_path in files)
+        for student, files in group_by_student(file_paths).items()
+    }
+
+
+def load_incremental_state(state_path):
+    if not os.path.isfile(state_path):
+        return None
+    with open(state_path, "r") as f:
+        state = json.load(f)
+    if not os.path.isfile(state["report"]):
+        print(
+            f"WARNING: previous report {state['report']} no longer exists, running a full query."
+        )
+        return None
+    return state
+
+
+def save_incremental_state(state_path, hashes, report):
+    with open(state_path, "w") as f:
+        json.dump({"submissions": hashes, "report": report}, f, indent=1)
+
+
+def pick_related_submissions(changed_files, previous_files, n):
+    """
+    Return the n students in previous_files whose code shares the most
+    (whitespace-normalised) lines with any of the changed submissions. These are
+    sent along with the changed submissions so MOSS can find matches against them.
+    """
+    changed = [
+        {normalise_line(line) for line in read_submission_lines(files)} - {""}
+        for files in group_by_student(changed_files).values()
+    ]
+    scores = []
+    for student, files in group_by_student(previous_files).items():
+        lines = {normalise_line(line) for line in read_submission_lines(files)} - {""}
+        if not lines:
+            continue
+        score = max(
+            (
+                len(lines & other) / min(len(lines), len(other))
+                for other in changed
+                if other
+            ),
+            default=0.0,
+        )
+        scores.append((score, student))
+    scores.sort(reverse=True)
+    return [student for _, student in scores[:n]]
+
+
+def merge_reports(previous_index, new_index, changed, removed, output_path):
+    """
+    Write a report index to output_path with every row of new_index that involves a
+    changed submission, plus the rows of previous_index that involve neither a changed
+    nor a removed submission. Links are rewritten relative to output_path so match
+    pages are served from the report directory they were downloaded into.
+    """
+    from bs4 import BeautifulSoup
+
+    rows = []
+
+    def read_rows(index_path, keep):
+        with open(index_path, "rb") as f:
+            soup = BeautifulSoup(f.read(), "lxml")
+        prefix = os.path.relpath(
+            os.path.dirname(os.path.abspath(index_path)),
+            os.path.dirname(os.path.abspath(output_path)),
+        ).replace(os.sep, "/")
+        for row in soup.find_all("tr"):
+            columns = row.find_all("td")
+            if len(columns) < 3:
+                continue
+            names = {
+                columns[0].text.strip().split(" ")[0].split("/")[-2],
+                columns[1].text.strip().split(" ")[0].split("/")[-2],
+            }
+            if not keep(names):
+                continue
+            for link in row.find_all("a"):
+                # links to pages that were not downloaded point at the MOSS server
+                if (
+                    link.has_attr("href")
+                    and prefix != "."
+                    and "://" not in link["href"]
+                ):
+                    link["href"] = posixpath.normpath(prefix + "/" + link["href"])
+            rows.append((int(columns[2].text.strip()), str(row)))
+
+    if new_index is not None:
+        read_rows(new_index, lambda names: bool(names & changed))
+    read_rows(previous_index, lambda names: not (names & (changed | removed)))
+    rows.sort(key=lambda row: row[0], reverse=True)
+
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write("<html><head><title>Merged MOSS report</title></head><body>\n")
+        f.write(
+            "<table>\n<tr><th>File 1</th><th>File 2</th><th>Lines Matched</th></tr>\n"
+        )
+        f.write("\n".join(row for _, row in rows))
+        f.write("\n</table>\n</body></html>\n")
+    return output_path
+
+
+# MOSS deletes reports after 14 days, so cached urls are only valid for that long
+CACHE_MAX_AGE_DAYS = 14
+
+
+def query_cache_key(moss, server, duplicates=()):
+    """
+    Hash everything that determines the result of a query, including the server
+    (host:port) it is sent to, so a report from a local stand-in is never reused
+    for the real MOSS, and the duplicate submissions that were not uploaded, which
+    the report lists in duplicates.csv. The files are hashed in sorted order, so
+    listing them in another order gives the same key.
+    """
+    digest = hashlib.sha256()
+    digest.update(f"server {server}\n".encode())
+    digest.update(json.dumps(moss.options, sort_keys=True).encode())
+    lines = []
+    for kind, files in (("base", moss.base_files), ("file", moss.files)):
+        for file_path, display_name in files:
+            if display_name is None:
+                display_name = file_path.replace(" ", "_").replace("\\", "/")
+            content_hash, _ = hash_file(file_path)
+            lines.append(f"{kind} {display_name} {content_hash}\n")
+    for representative, duplicate, _ in duplicates:
+        lines.append(f"duplicate {duplicate} {representative}\n")
+    for line in sorted(lines):
+        digest.update(line.encode())
+    return digest.hexdigest()
+
+
+def cache_lookup(cache_dir, key, server, max_age_days=CACHE_MAX_AGE_DAYS):
+    entry_path = os.path.join(cache_dir, f"{key}.json")
+    try:
+        with open(entry_path, "r") as f:
+            entry = json.load(f)
+        # entries from before the server was recorded are not trusted
+        if entry.get("server") != server:
+            return None
+        if time.time() - entry["created"] > max_age_days * 24 * 60 * 60:
+            remove_cache_entry(entry_path)
+            return None
+        # entries are evicted least recently used first, so mark this one as used
+        os.utime(entry_path)
+    except FileNotFoundError:
+        # never cached, or evicted by another run
+        return None
+    return entry
+
+
+def cache_store(cache_dir, key, server, url, report, created=None, max_entries=256):
+    # created is carried over when a cached entry is rewritten, since the url still
+    # expires 14 days after MOSS made it
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, f"{key}.json"), "w") as f:
+        json.dump(
+            {
+                "server": server,
+                "url": url,
+                "report": os.path.abspath(report),
+                "created": time.time() if created is None else created,
+            },
+            f,
+        )
+
+    entries = scan_cache(cache_dir, ".json")
+    for _, entry_path in entries[: max(0, len(entries) - max_entries)]:
+        remove_cache_entry(entry_path)
+
+
+def scan_cache(cache_dir, suffix=""):
+    """
+    Return (mtime, path) of the entries in cache_dir whose name ends with suffix,
+    oldest first. Other runs (eg. the queries of --per-question) share the cache and
+    may remove entries meanwhile, so those are left out.
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if not entry.name.endswith(suffix):
+            continue
+        try:
+            entries.append((entry.stat().st_mtime, entry.path))
+        except FileNotFoundError:
+            pass
+    return sorted(entries)
+
+
+def remove_cache_entry(entry_path):
+    try:
+        os.remove(entry_path)
+    except FileNotFoundError:
+        # already evicted by another run
+        pass
+
+
+# bump when the normalisers change, so their cached output is not reused
+NORMALISE_VERSION = 1
+C_FAMILY_LANGUAGES = {"c", "cc", "java", "csharp", "javascript"}
+C_TOKEN = re.compile(
+    r"(?P<comment>//[^\n]*|/\*.*?\*/)"
+    r"|(?P<string>\"(?:\\.|[^\"\\\n])*\"|'(?:\\.|[^'\\\n])*')"
+    r"|(?P<space>(?<=\S)[ \t]+)",
+    re.DOTALL,
+)
+TRAILING_SPACE = re.compile(r"[ \t]+$", re.MULTILINE)
+
+
+def normalise_c(source):
+    def replace(match):
+        if match.group("comment") is not None:
+            return "\n" * match.group("comment").count("\n") or " "
+        if match.group("space") is not None:
+            return " "
+        return match.group()
+
+    return C_TOKEN.sub(replace, source)
+
+
+def normalise_python(source):
+    lines = io.StringIO(source).readlines()
+    line_starts = [0]
+    for line in lines:
+        line_starts.append(line_starts[-1] + len(line))
+
+    def offset(position):
+        row, col = position
+        return line_starts[row - 1] + col
+
+    tokens = list(tokenize.generate_tokens(io.StringIO(source).readline))
+    skipped = (tokenize.COMMENT, tokenize.NL)
+    edits = []
+    statement_start = True
+    for i, token in enumerate(tokens):
+        if token.type == tokenize.COMMENT:
+            edits.append((offset(token.start), offset(token.end), ""))
+        elif token.type == tokenize.STRING and statement_start:
+            # a string on its own is a docstring, or a comment in disguise
+            following = next(t for t in tokens[i + 1 :] if t.type not in skipped)
+            if following.type in (tokenize.NEWLINE, tokenize.ENDMARKER):
+                edits.append(
+                    (
+                        offset(token.start),
+                        offset(token.end),
+                        "\n" * token.string.count("\n"),
+                    )
+                )
+        if i > 0 and tokens[i - 1].end[0] == token.start[0]:
+            # the whitespace between two tokens on a line, but not the indentation
+            start, end = offset(tokens[i - 1].end), offset(token.start)
+            if end - start > 1 and not source[start:end].strip():
+                edits.append((start, end, " "))
+        if token.type not in skipped:
+            statement_start = token.type in (
+                tokenize.NEWLINE,
+                tokenize.INDENT,
+                tokenize.DEDENT,
+            )
+
+    pieces = []
+    position = 0
+    for start, end, replacement in sorted(edits):
+        pieces.append(source[position:start])
+        pieces.append(replacement)
+        position = end
+    pieces.append(source[position:])
+    return "".join(pieces)
+
+
+def normalise_source(source, language):
+    """
+    Strip the comments (and in python, docstrings) and the repeated or trailing
+    whitespace that MOSS would discard anyway. Every line stays on the same line
+    number, so the line ranges in the report still match the submitted files.
+    Other languages only lose trailing whitespace.
+    """
+    try:
+        if language == "python":
+            source = normalise_python(source)
+        elif language in C_FAMILY_LANGUAGES:
+            source = normalise_c(source)
+    except (tokenize.TokenError, SyntaxError):
+        # code that does not tokenise is sent as it is
+        pass
+    return TRAILING_SPACE.sub("", source)
+
+
+def normalise_file(file_path, language, cache_dir):
+    """
+    Write the normalised contents of file_path into cache_dir, named by a hash of
+    the original contents, unless they are there already. Returns (normalised path,
+    original size, normalised size, whether it was cached).
+    """
+    with open(file_path, "rb") as f:
+        content = f.read()
+    digest = hashlib.sha256(f"{NORMALISE_VERSION} {language}\n".encode())
+    digest.update(content)
+    normalised_path = os.path.join(
+        cache_dir, digest.hexdigest() + os.path.splitext(file_path)[1]
+    )
+    try:
+        size = os.path.getsize(normalised_path)
+        # recently used files are kept when the cache is pruned
+        os.utime(normalised_path)
+        return normalised_path, len(content), size, True
+    except FileNotFoundError:
+        pass
+
+    # surrogateescape keeps bytes that are not utf-8 as they are
+    source = content.decode("utf-8", errors="surrogateescape")
+    normalised = normalise_source(source, language).encode(
+        "utf-8", errors="surrogateescape"
+    )
+    temp_path = f"{normalised_path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(normalised)
+    os.replace(temp_path, normalised_path)
+    return normalised_path, len(content), len(normalised), False
+
+
+def normalise_submissions(moss, cache_dir, max_age_days=CACHE_MAX_AGE_DAYS):
+    """
+    Replace the files and base files queued in moss with normalised copies, made in
+    a process pool and cached in cache_dir, under the same display names. Returns
+    (bytes before, bytes after, number of files that were cached).
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    queued = moss.base_files + moss.files
+    with ProcessPoolExecutor() as executor:
+        results = list(
+            executor.map(
+                normalise_file,
+                [file_path for file_path, _ in queued],
+                repeat(moss.options["l"]),
+                repeat(cache_dir),
+                chunksize=16,
+            )
+        )
+
+    normalised = []
+    for (file_path, display_name), (normalised_path, _, size, _) in zip(
+        queued, results
+    ):
+        if display_name is None:
+            display_name = file_path.replace(" ", "_").replace("\\", "/")
+        moss.file_sizes.pop(file_path, None)
+        moss.file_sizes[normalised_path] = size
+        normalised.append((normalised_path, display_name))
+    moss.base_files = normalised[: len(moss.base_files)]
+    moss.files = normalised[len(moss.base_files) :]
+
+    cutoff = time.time() - max_age_days * 24 * 60 * 60
+    for mtime, entry_path in scan_cache(cache_dir):
+        if mtime < cutoff:
+            remove_cache_entry(entry_path)
+
+    return (
+        sum(before for _, before, _, _ in results),
+        sum(after for _, _, after, _ in results),
+        sum(cached for _, _, _, cached in results),
+    )
+
+
+def load_discovery_manifest(manifest_path, submissions_dir):
+    """
+    Return {student: [(file path, size or None if unknown)]} from the manifest
+    written by sort_submissions_gradescope.py, or None if there is none, or it has no files
+    in submissions_dir or other submissions than those in submissions_dir. Files
+    sorted elsewhere, eg. into the directory of another question, are skipped. A
+    student whose directory no longer holds the files listed gets the files in it
+    instead, with their sizes unknown.
+    """
+    if not manifest_path or not os.path.isfile(manifest_path):
+        return None
+
+    students = {}
+    with open(manifest_path, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            if not row["Sorted Path"]:
+                continue
+            student_dir, file_name = os.path.split(row["Sorted Path"])
+            if os.path.normpath(os.path.dirname(student_dir)) != os.path.normpath(
+                submissions_dir
+            ):
+                continue
+            student = os.path.basename(student_dir)
+            # older manifests only have the size of the original file
+            size = row.get("Sorted Size", row["Size"])
+            students.setdefault(student, []).append(
+                (
+                    os.path.join(submissions_dir, student, file_name),
+                    int(size) if size else None,
+                )
+            )
+
+    # a single listing of the sorted directory catches submissions sorted since
+    if not students or set(os.listdir(submissions_dir)) != set(students):
+        return None
+    # and a listing of each student directory files added or deleted since
+    for student, files in students.items():
+        student_dir = os.path.join(submissions_dir, student)
+        try:
+            # the same files glob.glob(f"{student_dir}/*") finds
+            names = [
+                name for name in os.listdir(student_dir) if not name.startswith(".")
+            ]
+        except OSError:
+            return None
+        if set(names) != {os.path.basename(file) for file, _ in files}:
+            students[student] = [
+                (os.path.join(student_dir, name), None) for name in names
+            ]
+    return students
+
+
+# how much of each file is read to tell whether it is binary
+SNIFF_SIZE = 8192
+
+
+def unsendable(file_path, size=None, max_size=0):
+    """
+    Return why file_path should not be uploaded: "binary" if its first SNIFF_SIZE
+    bytes have a NUL byte, or "too large" if it is over max_size bytes. None if it
+    can be sent.
+    """
+    try:
+        with open(file_path, "rb") as f:
+            if size is None:
+                size = os.fstat(f.fileno()).st_size
+            if b"\0" in f.read(SNIFF_SIZE):
+                return "binary"
+    except OSError:
+        # missing files are reported by addFile
+        return None
+    if max_size and size > max_size:
+        return "too large"
+    return None
+
+
+def find_submission_files(submissions_dir, dir_mode, file_pattern, manifest=None):
+    students = list(manifest) if manifest is not None else os.listdir(submissions_dir)
+    moss_files_to_submit = []
+
+    for student in students:
+        if manifest is not None:
+            files = [file for file, _ in manifest[student]]
+        else:
+            student_dir = os.path.join(submissions_dir, student)
+            files = glob.glob(f"{student_dir}/*")
+        if len(files) == 0:
+            print(f"submission: {student} has no files, skipping.")
+            continue
+
+        file_found = False
+        for file in files:
+            if dir_mode:
+                moss_files_to_submit.append(file)
+                continue
+            if len(file_pattern) != 0:
+                if re.search(file_pattern, file, re.IGNORECASE) is not None:
+                    moss_files_to_submit.append(file)
+                    file_found = True
+                    break
+            else:
+                print("dir_mode not set and file_pattern empty!")
+                sys.exit(1)
+        if not file_found and not dir_mode:
+            if len(files) == 1:
+                moss_files_to_submit.append(files[0])
+                continue
+            print("File not found for student: ", student, len(files))
+            for i in range(len(files)):
+                print(f"{i}: {os.path.basename(files[i])}")
+
+            try:
+                idx = int(
+                    input("Enter the index of the file to submit, or return to skip: ")
+                )
+            except ValueError:
+                continue
+
+            moss_files_to_submit.append(files[idx])
+
+    return moss_files_to_submit
+
+
+def print_upload_summary(moss):
+    total_bytes, total_secs, slowest = moss.getUploadSummary()
+    if slowest is None:
+        return
+    rate = total_bytes / total_secs if total_secs > 0 else 0.0
+    print(
+        f"Uploaded {len(moss.upload_stats)} files, {total_bytes / 1e6:.2f} MB in {total_secs:.2f}s ({rate / 1e6:.2f} MB/s)"
+    )
+    print(
+        f"Mean per-file latency {1000 * total_secs / len(moss.upload_stats):.1f}ms, slowest {slowest[0]} ({slowest[1]} bytes) {1000 * slowest[2]:.1f}ms"
+    )
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Submit files to MOSS for plagiarism detection. The final line of output will be path to the index.html file of the downloaded report.",
@@ -329,6 +2009,12 @@ def main():
         default="./sorted",
         help="Directory where student submissions are stored.",
     )
+    parser.add_argument(
+        "--discovery-manifest",
+        type=str,
+        default="submissions_manifest.csv",
+        help="The manifest written by sort_submissions_gradescope.py. If it lists the submissions in --submissions-dir, their files and sizes are taken from it instead of listing and statting every file again. Empty to always list the directory.",
+    )
 
     parser.add_argument(
         "-o",
@@ -354,6 +2040,12 @@ def main():
     )
 
     parser.add_argument("--userid", type=int, required=False, help="User ID for MOSS.")
+    parser.add_argument(
+        "--moss-server",
+        type=str,
+        default=f"{Moss.server}:{Moss.port}",
+        help="host:port of the MOSS server, eg. localhost:7690 for moss_standin_server.py.",
+    )
     parser.add_argument(
         "-l",
         "--language",
@@ -394,6 +2086,161 @@ def main():
         help="Disable directory mode. Directory mode treats all files in a directory as a single submission, disabling it will send them individually.",
     )
 
+    parser.add_argument(
+        "--infer-base-file",
+        type=float,
+        default=0.0,
+        metavar="FRACTION",
+        help="If set, build a base file from passages that appear in more than this fraction (0-1) of submissions, eg. skeleton code, and add it to --base-files.",
+    )
+    parser.add_argument(
+        "--inferred-base-file-path",
+        type=str,
+        default="./inferred_base_file.txt",
+        help="Where to write the base file built by --infer-base-file.",
+    )
+
+    parser.add_argument(
+        "--dedupe",
+        type=str,
+        default="exact",
+        choices=["off", "exact", "whitespace"],
+        help="Upload only one copy of identical submissions. 'whitespace' also treats submissions differing only in whitespace as identical. Duplicates are written to duplicates.csv in the report directory as 100%% matches.",
+    )
+
+    parser.add_argument(
+        "--max-file-size",
+        type=int,
+        default=1000000,
+        help="Files larger than this many bytes are not uploaded, nor are binary files. 0 for no limit.",
+    )
+
+    parser.add_argument(
+        "--normalise",
+        action="store_true",
+        default=False,
+        help="Strip comments, docstrings and extra whitespace (for python and c-like languages) before uploading, keeping every line on the same line number. The normalised files are cached in CACHE_DIR/normalised by the hash of their contents.",
+    )
+
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        default=False,
+        help="Remember the submissions sent in this run. On the next run with this flag, only new or changed submissions (and the most related previous ones) are sent, and the new matches are merged into the previous report.",
+    )
+    parser.add_argument(
+        "--incremental-state",
+        type=str,
+        default="./moss_incremental.json",
+        help="Where --incremental keeps the content hashes and report of the last run.",
+    )
+    parser.add_argument(
+        "--incremental-related",
+        type=int,
+        default=25,
+        help="Number of previous submissions most similar to the changed ones to send with them in --incremental mode.",
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=os.path.join(os.path.expanduser("~"), ".cache", "moss_gradescope"),
+        help=f"Directory to cache report urls in. Sending exactly the same files and options again within {CACHE_MAX_AGE_DAYS} days reuses the cached report instead of querying MOSS.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        default=False,
+        help="Always query MOSS, and don't cache the report.",
+    )
+
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=30,
+        help="Seconds to wait when connecting to the MOSS server.",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=120,
+        help="Seconds to wait for the MOSS server to accept more data before giving up on the session.",
+    )
+    parser.add_argument(
+        "--query-timeout",
+        type=float,
+        default=30 * 60,
+        help="Seconds to wait for MOSS to return the report url once all files are uploaded.",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="Number of times to retry a failed MOSS session.",
+    )
+    parser.add_argument(
+        "--retry-backoff",
+        type=float,
+        default=10,
+        help="Seconds to wait before the first retry, doubling for every following retry.",
+    )
+    parser.add_argument(
+        "--upload-plan",
+        type=str,
+        default=None,
+        help="Save the files and options to send to this file before sending, and remove it once the report is downloaded. If it already exists, it is sent as is, skipping the file discovery, hashing and base file inference.",
+    )
+
+    parser.add_argument(
+        "--min-similarity",
+        type=int,
+        default=None,
+        help="Only download the match pages of pairs where either similarity percentage is above this. Other pairs in the report link to the MOSS server.",
+    )
+    parser.add_argument(
+        "--min-lines-matched",
+        type=int,
+        default=None,
+        help="Only download the match pages of pairs with more than this many lines matched.",
+    )
+    parser.add_argument(
+        "--top-matches",
+        type=int,
+        default=None,
+        help="Only download the match pages of this many of the most similar pairs.",
+    )
+    parser.add_argument(
+        "--graph-output",
+        type=str,
+        default=None,
+        help="If set, write the network graph of moss_nodes.py here as soon as the report index is downloaded, while the match pages download in the background. DOWNLOAD_COMPLETE is written to the report directory when they are done.",
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        default=False,
+        action="store_true",
+        help="Overwrite --graph-output if it already exists.",
+    )
+    parser.add_argument(
+        "--archive",
+        action="store_true",
+        default=False,
+        help="Download the report into a single zip file, REPORT_OUTPUT_DIR.zip, instead of a directory. View it with moss_report_viewer.py.",
+    )
+    parser.add_argument(
+        "--download-url",
+        type=str,
+        default=None,
+        help="Only download the report at this MOSS url, without sending anything. An interrupted download of the same url in --report-output-dir is resumed.",
+    )
+    parser.add_argument(
+        "--refresh-index",
+        action="store_true",
+        default=False,
+        help="With --download-url, only download index.html again.",
+    )
+
     parser.add_argument(
         "--open-browser",
         action="store_true",
@@ -401,10 +2248,105 @@ def main():
         help="If set, open the MOSS report in a browser after downloading.",
     )
 
+    parser.add_argument(
+        "--per-question",
+        action="store_true",
+        default=False,
+        help="Send one query per question directory (Q1, Q2, ...) of --submissions-dir, as sorted by 'sort_submissions_gradescope.py --per-question', at the same time. The report of each question goes into REPORT_OUTPUT_DIR_Q1 and so on, and the other output files get the same suffix. Their report paths are printed last, one per line. A question whose query fails does not stop the others, but the script then exits with an error.",
+    )
+
     args = parser.parse_args()
 
+    if not args.per_question:
+        print(f"{submit(args)}")
+        return
+
+    questions = sorted(
+        (q for q in os.listdir(args.submissions_dir) if re.fullmatch(r"Q\d+", q)),
+        key=lambda q: int(q[1:]),
+    )
+    if not questions:
+        print(f"No question directories found in {args.submissions_dir}.")
+        sys.exit(1)
+
+    def submit_question(question):
+        # one failed question must not lose the reports of the others. submit() exits
+        # after printing why on errors it cannot recover from
+        try:
+            return submit(question_args(args, question))
+        except SystemExit:
+            print(f"The query for {question} failed, see above.")
+        except Exception as e:
+            print(f"The query for {question} failed: {e}")
+        return None
+
+    with ThreadPoolExecutor(max_workers=len(questions)) as executor:
+        reports = list(executor.map(submit_question, questions))
+    failed = [
+        q for q, report_output in zip(questions, reports) if report_output is None
+    ]
+    print()
+    if failed:
+        print(f"No report for {', '.join(failed)}.")
+    for report_output in reports:
+        if report_output is not None:
+            print(f"{report_output}")
+    if failed:
+        sys.exit(1)
+
+
+def with_suffix(path, suffix):
+    root, ext = os.path.splitext(path)
+    return f"{root}_{suffix}{ext}"
+
+
+def question_args(args, question):
+    # the same options, with the files of one question and outputs of its own
+    args = argparse.Namespace(**vars(args))
+    args.submissions_dir = os.path.join(args.submissions_dir, question)
+    args.base_files = list(args.base_files)
+    args.report_output_dir = f"{os.path.normpath(args.report_output_dir)}_{question}"
+    args.incremental_state = with_suffix(args.incremental_state, question)
+    args.inferred_base_file_path = with_suffix(args.inferred_base_file_path, question)
+    if args.upload_plan:
+        args.upload_plan = with_suffix(args.upload_plan, question)
+    if args.graph_output:
+        args.graph_output = with_suffix(args.graph_output, question)
+    return args
+
+
+def submit(args):
+    """
+    Send the query described by the parsed arguments, download its report and
+    return the path to it.
+    """
+    if args.graph_output and os.path.isfile(args.graph_output) and not args.force:
+        print(
+            f"The file {args.graph_output} already exists. Specify a different file using --graph-output, or use the --force flag to overwrite it."
+        )
+        sys.exit(1)
+
+    if args.archive and args.incremental:
+        print("--archive can not be used with --incremental.")
+        sys.exit(1)
+
     submissions_dir = args.submissions_dir
     report_output_dir = args.report_output_dir
+
+    if args.download_url:
+        report_output = download_report(
+            args.download_url,
+            report_output_dir,
+            connections=8,
+            log_level=20,
+            on_read=lambda url: print(f"Downloaded file: {url}\n", end="", flush=True),
+            index_only=args.refresh_index,
+            min_similarity=args.min_similarity,
+            min_lines=args.min_lines_matched,
+            top=args.top_matches,
+            archive=args.archive,
+        )
+        return report_output
     file_pattern = args.file_pattern
 
     userid = args.userid
@@ -421,84 +2363,212 @@ def main():
     if args.no_dir_mode:
         dir_mode = False
 
-    base_files = args.base_files
-
-    students = os.listdir(submissions_dir)
-    moss_files_to_submit = []
+    # a copy, as the inferred base file is added to it and the queries of
+    # --per-question share args.base_files
+    base_files = list(args.base_files)
+
+    plan = None
+    if args.upload_plan and os.path.isfile(args.upload_plan):
+        print(f"Resuming the upload plan saved in {args.upload_plan}")
+        with open(args.upload_plan, "r") as f:
+            plan = json.load(f)
+    else:
+        discovery = load_discovery_manifest(args.discovery_manifest, submissions_dir)
+        if discovery is not None:
+            print(f"Using the submission files listed in {args.discovery_manifest}")
+        moss_files_to_submit = find_submission_files(
+            submissions_dir, dir_mode, file_pattern, discovery
+        )
+        file_sizes = {
+            file: size for files in (discovery or {}).values() for file, size in files
+        }
+
+        # a binary or huge file can stall the upload and break the whole query
+        reasons = {
+            file: unsendable(file, file_sizes.get(file), args.max_file_size)
+            for file in moss_files_to_submit
+        }
+        skipped = [file for file in moss_files_to_submit if reasons[file]]
+        if skipped:
+            print(f"Not uploading {len(skipped)} binary or oversized files:")
+            for file in skipped:
+                print(f"  {file} ({reasons[file]})")
+            moss_files_to_submit = [
+                file for file in moss_files_to_submit if not reasons[file]
+            ]
+
+        # the base file is inferred from every submission, not only those an
+        # incremental run sends, which are picked because they resemble each other
+        all_files_to_submit = moss_files_to_submit
+
+        incremental = None
+        if args.incremental:
+            hashes = submission_hashes(moss_files_to_submit)
+            state = load_incremental_state(args.incremental_state)
+            incremental = {"hashes": hashes, "previous_report": None}
+
+            if state is not None:
+                changed = {
+                    student
+                    for student, key in hashes.items()
+                    if state["submissions"].get(student) != key
+                }
+                removed = set(state["submissions"]) - set(hashes)
+                print(
+                    f"Incremental mode: {len(changed)} new or changed and {len(removed)} removed submissions since the last run."
+                )
+                if not changed and not removed:
+                    print("Nothing to send, the previous report is up to date.")
+                    return state["report"]
+                if not changed:
+                    report_output = merge_reports(
+                        state["report"],
+                        None,
+                        changed,
+                        removed,
+                        os.path.join(make_dir(report_output_dir), "index.html"),
+                    )
+                    save_incremental_state(
+                        args.incremental_state, hashes, report_output
+                    )
+                    return report_output
+
+                changed_files = [
+                    f for f in moss_files_to_submit if student_of(f) in changed
+                ]
+                related = set(
+                    pick_related_submissions(
+                        changed_files,
+                        [
+                            f
+                            for f in moss_files_to_submit
+                            if student_of(f) not in changed
+                        ],
+                        args.incremental_related,
+                    )
+                )
+                print(
+                    f"Sending the changed submissions with {len(related)} related previous submissions."
+                )
+                moss_files_to_submit = [
+                    f
+                    for f in moss_files_to_submit
+                    if student_of(f) in changed | related
+                ]
+                incremental.update(
+                    previous_report=state["report"],
+                    changed=sorted(changed),
+                    removed=sorted(removed),
+                )
 
-    for student in students:
-        student_dir = os.path.join(submissions_dir, student)
-        files = glob.glob(f"{student_dir}/*")
-        if len(files) == 0:
-            print(f"submission: {student} has no files, skipping.")
-            continue
+        try:
+            m = Moss(userid, language)
 
-        file_found = False
-        for file in files:
             if dir_mode:
-                moss_files_to_submit.append(file)
-                continue
-            if len(file_pattern) != 0:
-                if re.search(file_pattern, file, re.IGNORECASE) is not None:
-                    moss_files_to_submit.append(file)
-                    file_found = True
-                    break
-            else:
-                print("dir_mode not set and file_pattern empty!")
-                sys.exit(1)
-        if not file_found and not dir_mode:
-            if len(files) == 1:
-                moss_files_to_submit.append(files[0])
-                continue
-            print("File not found for student: ", student, len(files))
-            for i in range(len(files)):
-                print(f"{i}: {os.path.basename(files[i])}")
-
-            try:
-                idx = int(
-                    input("Enter the index of the file to submit, or return to skip: ")
+                print("Setting directory mode and sending all files")
+                m.setDirectoryMode(1)
+
+            # use the line below to specify a "base file" that will be ignored in the comparison
+            # this should be used to include code that all students will have in their submission,
+            # eg, if you provided a template.
+
+            if args.infer_base_file > 0:
+                n_passages = infer_base_file(
+                    all_files_to_submit,
+                    args.infer_base_file,
+                    args.inferred_base_file_path,
                 )
-            except ValueError:
-                continue
+                print(
+                    f"found {n_passages} passages shared by more than {100 * args.infer_base_file:.0f}% of submissions"
+                )
+                if n_passages > 0:
+                    base_files.append(args.inferred_base_file_path)
+
+            for file in base_files:
+                print(f"adding base file: {file}")
+                m.addBaseFile(file)
+
+            # add the concatenated files
+            for f in moss_files_to_submit:
+                m.addFile(f, size=file_sizes.get(f))
+
+            duplicates = []
+            if args.dedupe != "off":
+                duplicates = dedupe_submissions(m, args.dedupe == "whitespace")
+                if duplicates:
+                    print(
+                        f"{len(duplicates)} duplicate submissions will not be uploaded, see duplicates.csv in the report directory."
+                    )
+
+            if args.normalise:
+                before, after, cached = normalise_submissions(
+                    m, os.path.join(args.cache_dir, "normalised")
+                )
+                print(
+                    f"Normalised {len(m.base_files) + len(m.files)} files ({cached} cached) from {before / 1e6:.2f} MB to {after / 1e6:.2f} MB, saving {100 * (before - after) / max(before, 1):.0f}%"
+                )
+        except Exception as e:
+            print(f"Error: {e}")
+            sys.exit(1)
 
-            moss_files_to_submit.append(files[idx])
+        # everything needed to send the query and process the report, so a failed
+        # run can be restarted with the same --upload-plan without redoing the above
+        plan = {
+            "options": m.options,
+            "base_files": m.base_files,
+            "files": m.files,
+            "file_sizes": m.file_sizes,
+            "duplicates": duplicates,
+            "cache_key": (
+                None
+                if args.no_cache
+                else query_cache_key(m, args.moss_server, duplicates)
+            ),
+            "incremental": incremental,
+        }
+        if args.upload_plan:
+            with open(args.upload_plan, "w") as f:
+                json.dump(plan, f)
 
     try:
         m = Moss(userid, language)
+        m.server, m.port = args.moss_server.rsplit(":", 1)
+        m.port = int(m.port)
+        m.options = plan["options"]
+        m.base_files = [tuple(file) for file in plan["base_files"]]
+        m.files = [tuple(file) for file in plan["files"]]
+        m.file_sizes = plan.get("file_sizes", {})
+        m.setTimeouts(args.connect_timeout, args.idle_timeout, args.query_timeout)
+        m.setRetries(args.retries, args.retry_backoff)
     except Exception as e:
         print(f"Error: {e}")
         sys.exit(1)
 
-    try:
-        if dir_mode:
-            print("Setting directory mode and sending all files")
-            m.setDirectoryMode(1)
-
-        # use the line below to specify a "base file" that will be ignored in the comparison
-        # this should be used to include code that all students will have in their submission,
-        # eg, if you provided a template.
-
-        for file in base_files:
-            print(f"adding base file: {file}")
-            m.addBaseFile(file)
-
-        # add the concatenated files
-        n_files = len(moss_files_to_submit)
-        files_sent = []
+    duplicates = plan["duplicates"]
+    cache_key = plan["cache_key"]
+    incremental = plan["incremental"]
+    n_files = len(m.base_files) + len(m.files)
 
-        for f in moss_files_to_submit:
-            m.addFile(f)
+    def progress_func(file_path, display_name):
+        print(f"sending file {len(m.upload_stats)} of {n_files}\n", end="", flush=True)
 
-        def progress_func(file_path, display_name):
-            files_sent.append(file_path)
-            print(f"sending file {len(files_sent)} of {n_files}\n", end="", flush=True)
+    try:
+        cached = None
+        if cache_key is not None:
+            cached = cache_lookup(args.cache_dir, cache_key, args.moss_server)
 
-        url = m.send(
-            # lambda file_path, display_name: print(f"sending {file_path}\n", end="", flush=True)
-            progress_func
-        )
+        if cached is not None:
+            print("An identical query was sent recently, reusing its report.")
+            url = cached["url"]
+        else:
+            url = m.send(
+                # lambda file_path, display_name: print(f"sending {file_path}\n", end="", flush=True)
+                progress_func
+            )
     except Exception as e:
         print(f"Error: {e}")
+        if args.upload_plan:
+            print(f"Run again with --upload-plan {args.upload_plan} to retry.")
         sys.exit(1)
 
     if not url:
@@ -506,6 +2576,7 @@ def main():
         sys.exit(1)
 
     print()
+    print_upload_summary(m)
 
     # you can visit this URL straight away but it will be deleted after 14 days
     print()
@@ -515,23 +2586,90 @@ def main():
     print("Report Url: " + url)
     print()
 
-    # download the MOSS report to the report_output_dir
+    # everything that only needs index.html is done as soon as it is downloaded,
+    # while the match pages keep downloading.
+    final_report = []
+
+    def on_index(index_path):
+        if incremental is not None and incremental["previous_report"] is not None:
+            index_path = merge_reports(
+                incremental["previous_report"],
+                index_path,
+                set(incremental["changed"]),
+                set(incremental["removed"]),
+                os.path.join(os.path.dirname(index_path), "merged_index.html"),
+            )
+            print(f"Merged the new matches into the previous report: {index_path}")
+        final_report.append(index_path)
+
+        if args.graph_output:
+            import moss_nodes
+
+            thresholds = {}
+            if args.min_similarity is not None:
+                thresholds["min_similarity"] = args.min_similarity
+            if args.min_lines_matched is not None:
+                thresholds["min_lines_matched"] = args.min_lines_matched
+            moss_nodes.build_graph(
+                index_path,
+                args.graph_output,
+                open_browser=args.open_browser,
+                **thresholds,
+            )
+            print("The graph is ready, the rest of the report is still downloading.")
+
+    # download the MOSS report to the report_output_dir. If it was downloaded before,
+    # the missing pages of that download are fetched.
+    if cached is not None:
+        if cached["report"].endswith(".zip"):
+            report_output_dir = cached["report"][: -len(".zip")]
+        else:
+            report_output_dir = os.path.dirname(cached["report"])
     report_output = download_report(
         url,
         report_output_dir,
         connections=8,
         log_level=20,  # 10 to set to DEBUG, 20 disables logging.
         on_read=lambda url: print(f"Downloaded file: {url}\n", end="", flush=True),
+        min_similarity=args.min_similarity,
+        min_lines=args.min_lines_matched,
+        top=args.top_matches,
+        on_index=on_index,
+        archive=args.archive,
+        extra_files=(
+            {"duplicates.csv": duplicates_csv(duplicates)} if duplicates else None
+        ),
     )
+    if cache_key is not None:
+        cache_store(
+            args.cache_dir,
+            cache_key,
+            args.moss_server,
+            url,
+            report_output,
+            created=None if cached is None else cached["created"],
+        )
+
+    if final_report:
+        report_output = final_report[0]
+    if incremental is not None:
+        save_incremental_state(
+            args.incremental_state, incremental["hashes"], report_output
+        )
+
+    if args.upload_plan and os.path.isfile(args.upload_plan):
+        os.remove(args.upload_plan)
 
     print()
     print("The report download has completed.")
 
-    if args.open_browser:
+    if args.open_browser and args.archive:
+        print(f"View the report with: python3 moss_report_viewer.py {report_output}")
+    elif args.open_browser:
         print(f"Opening {report_output} in browser...")
         webbrowser.open(f"{report_output}")
 
-    print(f"{report_output}")
+    return report_output
 
 
 if __name__ == "__main__":
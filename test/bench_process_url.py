@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+# Benchmark the link rewriters of process_url on MOSS-like report pages generated by
+# moss_standin_server.py, and check that they produce equivalent pages.
+# python3 bench_process_url.py --lines 20000
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bs4 import BeautifulSoup  # noqa: E402
+from moss_standin_server import StandinServer  # noqa: E402
+from submit_to_moss import process_url  # noqa: E402
+
+
+def links_and_text(file_path):
+    with open(file_path, "rb") as f:
+        soup = BeautifulSoup(f.read(), "lxml")
+    links = [
+        (tag.name, tag.get("href"), tag.get("src"))
+        for tag in soup.find_all(["a", "frame"])
+    ]
+    return links, soup.get_text()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the process_url link rewriters.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--lines", type=int, default=20000, help="Lines of code per submission."
+    )
+    parser.add_argument("--submissions", type=int, default=4)
+    args = parser.parse_args()
+
+    server = StandinServer(http_port=80)
+    files = [
+        {
+            "id": i + 1,
+            "name": f"sorted/student_{i}/task.py",
+            # every submission shares a different subset of the lines
+            "body": "".join(
+                f"value_{j} = compute({j}, '<b>{i if j % (i + 2) == 0 else 0}</b>')\n"
+                for j in range(args.lines)
+            ).encode(),
+        }
+        for i in range(args.submissions)
+    ]
+    url = server.makeReport({"show": "250", "maxmatches": "10"}, files)
+    pages = server.reports[url.rsplit("/", 1)[1]]
+    base_url = url + "/"
+
+    times = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for rewriter in ("soup", "fast"):
+            out_dir = os.path.join(tmp, rewriter)
+            os.makedirs(out_dir)
+            start = time.perf_counter()
+            for name, page in pages.items():
+                page_url = url if name == "index.html" else base_url + name
+                process_url(page_url, page.encode(), base_url, out_dir, rewriter)
+            times[rewriter] = time.perf_counter() - start
+
+        for name in pages:
+            soup_page = links_and_text(os.path.join(tmp, "soup", name))
+            fast_page = links_and_text(os.path.join(tmp, "fast", name))
+            if soup_page != fast_page:
+                print(f"MISMATCH: {name}")
+                sys.exit(1)
+
+    n_bytes = sum(len(page) for page in pages.values())
+    print(f"{len(pages)} pages, {n_bytes / 1e6:.2f} MB, links and text identical")
+    for rewriter, seconds in times.items():
+        print(f"{rewriter}: {seconds:.3f}s ({n_bytes / 1e6 / seconds:.1f} MB/s)")
+
+
+if __name__ == "__main__":
+    main()
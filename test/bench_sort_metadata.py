@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+# Benchmark reading submission_metadata.csv in sort_submissions_gradescope.py on a
+# synthetic export, against the previous per-row DictReader/strptime/print loop.
+# python3 bench_sort_metadata.py --rows 100000
+
+import argparse
+import contextlib
+import csv
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sort_submissions_gradescope import (  # noqa: E402
+    DATETIME_FORMAT,
+    read_submission_metadata,
+)
+
+COLUMNS = [
+    "First Name",
+    "Last Name",
+    "Student ID",
+    "Email",
+    "Sections",
+    "Status",
+    "Submission ID",
+    "Total Score",
+    "Max Points",
+    "Question 1 Score",
+    "Question 1 Weight",
+    "Question 1 Graded?",
+    "Question 1 Response",
+    "Question 1 Submitted At",
+]
+
+
+@dataclass
+class UnslottedSubmission:
+    id: str
+    names: list[str]
+    student_ids: list[str]
+    submitted_datetime: datetime
+    code_files: list[str]
+    pdf_files: list[str]
+    overdue_hrs: float
+
+
+def previous_read(metadata_path, due_datetime, overdue_leniency):
+    # the loop in process_submissions before it was streamed
+    tz_local = due_datetime.tzinfo
+    submissions = {}
+    with open(metadata_path, "r") as metadata_csv:
+        for row in csv.DictReader(metadata_csv):
+            if row["Status"] != "Missing":
+                submission_id = row["Submission ID"]
+                student_name = row["First Name"] + " " + row["Last Name"]
+                student_id = row["Student ID"]
+                if submission_id in submissions:
+                    print(
+                        f"Adding {student_name} to existing submission: {submission_id}"
+                    )
+                    submissions[submission_id].names.append(student_name)
+                    submissions[submission_id].student_ids.append(student_id)
+                    continue
+                print(f"Adding new submission for student {student_name}")
+                submission_datetime = datetime.strptime(
+                    row["Question 1 Submitted At"], DATETIME_FORMAT
+                ).astimezone(tz_local)
+                overdue_hrs = 0
+                if (submission_datetime - due_datetime) > overdue_leniency:
+                    overdue_hrs = (
+                        submission_datetime - (due_datetime + overdue_leniency)
+                    ) / timedelta(hours=1)
+                submissions[submission_id] = UnslottedSubmission(
+                    submission_id,
+                    [student_name],
+                    [student_id],
+                    submission_datetime,
+                    [],
+                    [],
+                    overdue_hrs,
+                )
+    return submissions
+
+
+def write_export(path, rows, group_fraction, missing_fraction):
+    rng = random.Random(0)
+    due = datetime.strptime("2024-10-02 10:00:00 +1000", DATETIME_FORMAT)
+    offsets = ["+1000", "+1100", "-0700", "+0000"]
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        submission_id = 100000000
+        n = 0
+        while n < rows:
+            submission_id += 1
+            members = 2 if rng.random() < group_fraction else 1
+            missing = rng.random() < missing_fraction
+            submitted = due + timedelta(minutes=rng.randint(-3000, 600))
+            submitted_at = (
+                ""
+                if missing
+                else submitted.strftime("%Y-%m-%d %H:%M:%S ") + rng.choice(offsets)
+            )
+            for _ in range(members):
+                n += 1
+                writer.writerow(
+                    [
+                        f"First{n}",
+                        f"Last{n}",
+                        str(40000000 + n),
+                        f"student{n}@example.com",
+                        "Tutorial",
+                        "Missing" if missing else "Ungraded",
+                        submission_id,
+                        "0.0",
+                        "15.0",
+                        "",
+                        "15.0",
+                        "false",
+                        '{"0"=>[{"text_file_id"=>674791352}]}',
+                        submitted_at,
+                    ]
+                )
+
+
+def measure(func):
+    # time and peak memory are measured in separate runs, as tracemalloc slows
+    # every allocation down. The result is summarised so it can be freed.
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - start
+
+        tracemalloc.start()
+        submissions = func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    summary = {
+        submission_id: (
+            submission.names,
+            submission.submitted_datetime,
+            submission.overdue_hrs,
+        )
+        for submission_id, submission in submissions.items()
+    }
+    return summary, seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark reading submission_metadata.csv.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument(
+        "--group-fraction",
+        type=float,
+        default=0.1,
+        help="Fraction of submissions made by a group of two.",
+    )
+    parser.add_argument(
+        "--missing-fraction",
+        type=float,
+        default=0.05,
+        help="Fraction of students without a submission.",
+    )
+    args = parser.parse_args()
+
+    due_datetime = datetime.strptime("2024-10-02 10:00:00 +1000", DATETIME_FORMAT)
+    overdue_leniency = timedelta(hours=1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        metadata_path = os.path.join(tmp, "submission_metadata.csv")
+        write_export(
+            metadata_path, args.rows, args.group_fraction, args.missing_fraction
+        )
+        print(
+            f"{args.rows} rows, {os.path.getsize(metadata_path) / 1e6:.1f} MB (per-row output goes to /dev/null)"
+        )
+
+        previous, previous_seconds, previous_peak = measure(
+            lambda: previous_read(metadata_path, due_datetime, overdue_leniency)
+        )
+        current, current_seconds, current_peak = measure(
+            lambda: read_submission_metadata(
+                metadata_path, due_datetime, overdue_leniency, {}
+            )
+        )
+
+    if previous != current:
+        print("MISMATCH: the submissions read are different")
+        sys.exit(1)
+
+    print(f"{len(current)} submissions, identical")
+    for name, seconds, peak in (
+        ("previous", previous_seconds, previous_peak),
+        ("streamed", current_seconds, current_peak),
+    ):
+        print(f"{name}: {seconds:.3f}s, peak {peak / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+# Benchmark Moss.send upload throughput against moss_standin_server.py.
+# python3 bench_upload.py --submissions 10000 --bandwidth 50000000
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from moss_standin_server import StandinServer  # noqa: E402
+from submit_to_moss import Moss, print_upload_summary  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark uploads to a local MOSS stand-in server.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--submissions", type=int, default=1000)
+    parser.add_argument("--file-size", type=int, default=4096, help="Bytes per file.")
+    parser.add_argument("--bandwidth", type=int, default=0)
+    parser.add_argument("--read-size", type=int, default=64 * 1024)
+    parser.add_argument("--port", type=int, default=17690)
+    args = parser.parse_args()
+
+    server = StandinServer(bandwidth=args.bandwidth, read_size=args.read_size)
+    threading.Thread(
+        target=asyncio.run, args=(server.serve(args.port),), daemon=True
+    ).start()
+    time.sleep(0.5)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        m = Moss(1, "python")
+        m.server, m.port = "localhost", args.port
+        m.setDirectoryMode(1)
+        for i in range(args.submissions):
+            os.makedirs(os.path.join(tmp, f"student_{i}"))
+            file_path = os.path.join(tmp, f"student_{i}", "task.py")
+            with open(file_path, "w") as f:
+                line = f"x_{i} = {i}  # student {i}\n"
+                f.write(line * (args.file_size // len(line) + 1))
+            m.addFile(file_path)
+
+        start = time.perf_counter()
+        url = m.send()
+        elapsed = time.perf_counter() - start
+
+    print(f"{args.submissions} files sent in {elapsed:.2f}s, report at {url}")
+    print_upload_summary(m)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,13 @@
+#!/usr/bin/env bash
+
+# same as run_test.sh, but against moss_standin_server.py so no MOSS userid or network is needed.
+
+rm moss_report lib sorted moss_network.html submissions_processed.csv submissions_manifest.csv -r
+
+python3 ../moss_standin_server.py --port 17690 &
+SERVER_PID=$!
+sleep 1
+
+MOSS_USERID=1 MOSS_SERVER=localhost:17690 ../check_similarity.sh "2024-10-02 10:00:00 +1000"
+
+kill $SERVER_PID